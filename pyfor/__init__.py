@@ -2,6 +2,14 @@ from __future__ import absolute_import
 
 __version__ = '0.2'
 
+from pyfor import lasio
+from pyfor import cache
+from pyfor import lasindex
+from pyfor import pointstore
+from pyfor import spatial
+from pyfor import interpolation
+from pyfor import terrain
+from pyfor import metrics
 from pyfor import cloud
 from pyfor import rasterizer
 from pyfor import gisexport
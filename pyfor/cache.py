@@ -0,0 +1,110 @@
+# An on disk cache of decoded point dimensions.
+
+import os
+import shutil
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from pyfor.pointstore import PointStore
+
+class DiskCache:
+    """
+    Caches decoded las dimensions as raw .npy files so that later loads of the same file are memory mapped instead \
+    of decoded. Entries are keyed on the absolute path, modification time and size of the las file, so a changed file \
+    is decoded again. When the total size of the cache exceeds max_bytes the least recently used entries are evicted.
+
+    Pass a DiskCache to Cloud to use it, i.e. Cloud(path, cache=DiskCache("/scratch/pyfor_cache", 50e9)).
+
+    :param directory: The directory that holds the cache, it is created if it does not exist.
+    :param max_bytes: The maximum size of the cache in bytes.
+    """
+    def __init__(self, directory, max_bytes=10e9):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, las_path):
+        """
+        Returns the cache key of a las file.
+        """
+        las_path = os.path.abspath(str(las_path))
+        stat = os.stat(las_path)
+        raw = "{}|{}|{}".format(las_path, stat.st_mtime_ns, stat.st_size)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def points(self, las_path, dims, decode):
+        """
+        Returns a PointStore of dims for a las file. Cached dimensions are memory mapped (copy on write, so the \
+        arrays can be modified without touching the cache), missing dimensions are decoded and added to the cache.
+
+        :param las_path: The path to the las file.
+        :param dims: An iterable of dimension names.
+        :param decode: A callable that takes a dimension name and returns its decoded array.
+        :return: A PointStore object.
+        """
+        key = self.key(las_path)
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+
+        added = False
+        columns = OrderedDict()
+        for dim in dims:
+            dim_path = os.path.join(entry, dim + ".npy")
+            if not os.path.exists(dim_path):
+                temp_path = dim_path + ".tmp"
+                with open(temp_path, "wb") as dim_file:
+                    np.save(dim_file, decode(dim))
+                os.replace(temp_path, dim_path)
+                added = True
+            columns[dim] = np.load(dim_path, mmap_mode="c")
+
+        # The modification time of an entry records when it was last used
+        os.utime(entry)
+        if added:
+            self.evict(keep=key)
+        return PointStore(columns)
+
+    @property
+    def entries(self):
+        """
+        A list of (key, size in bytes, last used time) tuples of every entry, least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((key, size, os.path.getmtime(entry)))
+        return sorted(entries, key=lambda item: item[2])
+
+    @property
+    def nbytes(self):
+        """The total size of the cache in bytes."""
+        return sum(size for key, size, used in self.entries)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is no larger than max_bytes.
+
+        :param keep: An optional key that is never evicted, i.e. the entry that is currently being loaded.
+        """
+        entries = self.entries
+        total = sum(size for key, size, used in entries)
+        for key, size, used in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        for key, size, used in self.entries:
+            shutil.rmtree(self._entry(key), ignore_errors=True)
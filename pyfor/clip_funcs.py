@@ -1,6 +1,6 @@
 import json
 import numpy as np
-from numba import vectorize, bool_, float64
+from numba import njit
 
 # These are the lower level clipping functions.
 
@@ -14,6 +14,11 @@ def square_clip(cloud, bounds):
     :return: A boolean mask, true is within the square
     """
 
+    raw_x = cloud.las.points.raw_coordinate("x")
+    raw_y = cloud.las.points.raw_coordinate("y")
+    if raw_x is not None and raw_y is not None:
+        return(_square_clip_raw(raw_x, raw_y, bounds))
+
     # Extact x y coordinates from cloud
     las_xy = cloud.las.points[["x", "y"]]
 
@@ -25,6 +30,42 @@ def square_clip(cloud, bounds):
 
     return(in_clip)
 
+def _square_clip_raw(raw_x, raw_y, bounds):
+    """
+    Clips a square from scaled integer coordinates without converting them to floats, the bounds are converted to \
+    the integer space instead.
+
+    :param raw_x: A tuple of (raw integer x, scale, offset), see PointStore.raw_coordinate.
+    :param raw_y: A tuple of (raw integer y, scale, offset).
+    :param bounds: A tuple of length 4, min x, min y, max x and max y coordinates of the square.
+    :return: A boolean mask, true is within the square
+    """
+    X, scale_x, offset_x = raw_x
+    Y, scale_y, offset_y = raw_y
+    x_in = (X >= np.ceil((bounds[0] - offset_x) / scale_x)) & (X <= np.floor((bounds[2] - offset_x) / scale_x))
+    y_in = (Y >= np.ceil((bounds[1] - offset_y) / scale_y)) & (Y <= np.floor((bounds[3] - offset_y) / scale_y))
+    return(x_in & y_in)
+
+@njit
+def _ray(x, y, poly):
+    # The polygon is an argument rather than a closure, so the function is only compiled once
+    inside = np.zeros(len(x), dtype=np.bool_)
+    n = len(poly)
+    for k in range(len(x)):
+        p1x, p1y = poly[0, 0], poly[0, 1]
+        xints = 0.0
+        for i in range(n + 1):
+            p2x, p2y = poly[i % n, 0], poly[i % n, 1]
+            if y[k] > min(p1y, p2y):
+                if y[k] <= max(p1y, p2y):
+                    if x[k] <= max(p1x, p2x):
+                        if p1y != p2y:
+                            xints = (y[k] - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                        if p1x == p2x or x[k] <= xints:
+                            inside[k] = not inside[k]
+            p1x, p1y = p2x, p2y
+    return inside
+
 def ray_trace(x, y, poly):
     """
     A numba implementation of the ray tracing algorithm.
@@ -34,28 +75,16 @@ def ray_trace(x, y, poly):
     :param poly: The coordinates of a polygon as a numpy array (i.e. from geo_json['coordinates']
     :return:
     """
-    @vectorize([bool_(float64, float64)])
-    def ray(x, y):
-        # where xy is a coordinate
-        n = len(poly)
-        inside = False
-        p2x = 0.0
-        p2y = 0.0
-        xints = 0.0
-        p1x, p1y = poly[0]
-        for i in range(n + 1):
-            p2x, p2y = poly[i % n]
-            if y > min(p1y, p2y):
-                if y <= max(p1y, p2y):
-                    if x <= max(p1x, p2x):
-                        if p1y != p2y:
-                            xints = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                        if p1x == p2x or x <= xints:
-                            inside = not inside
-            p1x, p1y = p2x, p2y
-        return inside
-    return(ray(x, y))
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    return(_ray(x, y, np.ascontiguousarray(poly, dtype=np.float64)))
+
 
+def polygon_coordinates(poly):
+    """
+    Returns the exterior coordinates of a shapely polygon as an N x 2 numpy array, for use in ray_trace.
+    """
+    return np.stack((poly.exterior.coords.xy[0], poly.exterior.coords.xy[1]), axis = 1)
 
 def poly_clip(cloud, poly):
     """
@@ -68,16 +97,86 @@ def poly_clip(cloud, poly):
     # Clip to bounding box
     bbox = poly.bounds
     pre_clip_mask = square_clip(cloud, bbox)
-    pre_clip = cloud.las.points[["x", "y"]].iloc[pre_clip_mask].values
+    pre_clip = cloud.las.points[["x", "y"]][pre_clip_mask].values
 
     # Store old indices
     pre_clip_inds = np.where(pre_clip_mask)[0]
 
     # Clip the preclip
-    poly_coords = np.stack((poly.exterior.coords.xy[0],
-                            poly.exterior.coords.xy[1]), axis = 1)
+    poly_coords = polygon_coordinates(poly)
 
     full_clip_mask = ray_trace(pre_clip[:,0], pre_clip[:,1], poly_coords)
     clipped = pre_clip_inds[full_clip_mask]
 
     return(clipped)
+
+def polygon_mask(x, y, poly):
+    """
+    Returns a boolean mask of the points inside a shapely Polygon or MultiPolygon, points inside holes are excluded.
+
+    :param x: A 1D numpy array of x coordinates.
+    :param y: A 1D numpy array of y coordinates.
+    :param poly: A shapely Polygon or MultiPolygon.
+    """
+    mask = np.zeros(len(x), dtype=bool)
+    for part in getattr(poly, "geoms", [poly]):
+        inside = ray_trace(x, y, polygon_coordinates(part))
+        for interior in part.interiors:
+            inside &= ~ray_trace(x, y, np.stack(interior.coords.xy, axis=1))
+        mask |= inside
+    return(mask)
+
+def polygon_membership(x, y, polygons, cell_size=None):
+    """
+    Finds the points inside each of many polygons in one pass. The points are bucketed into a grid once, so each \
+    polygon only tests the points of the cells that its bounding box intersects.
+
+    :param x: A 1D numpy array of x coordinates.
+    :param y: A 1D numpy array of y coordinates.
+    :param polygons: A sequence of shapely polygons, i.e. a geopandas GeoSeries.
+    :param cell_size: The size of the buckets. By default the median size of the polygon bounding boxes.
+    :return: A tuple of two 1D arrays, the index of each point that is inside a polygon and the position of that \
+    polygon in polygons. A point inside several overlapping polygons is listed once for each of them.
+    """
+    polygons = list(polygons)
+    bounds = np.array([poly.bounds for poly in polygons], dtype=np.float64).reshape(-1, 4)
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(x) == 0 or len(polygons) == 0:
+        return empty
+
+    min_x, min_y = np.min(x), np.min(y)
+    if cell_size is None:
+        cell_size = np.median(np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]))
+        cell_size = cell_size if cell_size > 0 else 1
+    n = int(np.floor((np.max(x) - min_x) / cell_size)) + 1
+    m = int(np.floor((np.max(y) - min_y) / cell_size)) + 1
+    cell_id = np.floor((y - min_y) / cell_size).astype(np.int64) * n + \
+              np.floor((x - min_x) / cell_size).astype(np.int64)
+
+    # A CSR index of the points in each bucket
+    order = np.argsort(cell_id, kind="mergesort")
+    cell_ptr = np.zeros(m * n + 1, dtype=np.int64)
+    cell_ptr[1:] = np.cumsum(np.bincount(cell_id, minlength=m * n))
+
+    point_ids, polygon_ids = [], []
+    for position, (poly, box) in enumerate(zip(polygons, bounds)):
+        col_min = max(int(np.floor((box[0] - min_x) / cell_size)), 0)
+        row_min = max(int(np.floor((box[1] - min_y) / cell_size)), 0)
+        col_max = min(int(np.floor((box[2] - min_x) / cell_size)), n - 1)
+        row_max = min(int(np.floor((box[3] - min_y) / cell_size)), m - 1)
+        if col_min > col_max or row_min > row_max:
+            continue
+
+        # The cells of one row are contiguous in the index
+        candidates = np.concatenate([order[cell_ptr[row * n + col_min]:cell_ptr[row * n + col_max + 1]]
+                                     for row in range(row_min, row_max + 1)])
+        cx, cy = x[candidates], y[candidates]
+        in_box = (cx >= box[0]) & (cx <= box[2]) & (cy >= box[1]) & (cy <= box[3])
+        candidates = candidates[in_box]
+        inside = candidates[polygon_mask(x[candidates], y[candidates], poly)]
+        point_ids.append(inside)
+        polygon_ids.append(np.full(len(inside), position, dtype=np.int64))
+
+    if len(point_ids) == 0:
+        return empty
+    return(np.concatenate(point_ids), np.concatenate(polygon_ids))
@@ -6,50 +6,249 @@ import pandas as pd
 import matplotlib.cm as cm
 from pyfor import rasterizer
 from pyfor import clip_funcs
+from pyfor import gisexport
+from pyfor import interpolation
 from pyfor import plot
+from pyfor import lasio
+from pyfor import lasindex
+from pyfor import spatial
+from pyfor.terrain import TerrainModel
+from pyfor.metrics import DEFAULT_PERCENTILES, group_metrics, metric_names
+from pyfor.pointstore import PointStore
 import pathlib
+from collections import OrderedDict
+from functools import partial
+
+# The dimensions ripped from laspy when loading a las file
+DEFAULT_DIMS = ("x", "y", "z", "intensity", "return_num", "classification", "flag_byte", "scan_angle_rank",
+                "user_data", "pt_src_id")
 
 class CloudData:
     """
-    A simple class composed of a numpy array of points and a laspy header, meant for internal use. This is basically
-    a way to load data from the las file into memory.
+    A simple class composed of a columnar store of points and a laspy header, meant for internal use. This is \
+    basically a way to load data from the las file into memory.
+
+    :param points: A pointstore.PointStore or a pandas DataFrame of points, DataFrames are converted to a PointStore.
+    :param header: A laspy header, or a lasio.LasHeader for clouds loaded from a cache.DiskCache.
     """
     def __init__(self, points, header):
+        if isinstance(points, pd.DataFrame):
+            points = PointStore.from_dataframe(points)
         self.points = points
-        self.x = self.points["x"]
-        self.y = self.points["y"]
-        self.z = self.points["z"]
-
         self.header = header
+        self._update()
+
+    @property
+    def min(self):
+        """The minimum x, y and z, computed the first time it is accessed after the points change."""
+        if self._min is None:
+            self._compute_extent()
+        return self._min
+
+    @min.setter
+    def min(self, value):
+        self._min = value
 
-        self.min = [np.min(self.x), np.min(self.y), np.min(self.z)]
-        self.max = [np.max(self.x), np.max(self.y), np.max(self.z)]
-        self.count = np.alen(self.points)
+    @property
+    def max(self):
+        """The maximum x, y and z, computed the first time it is accessed after the points change."""
+        if self._max is None:
+            self._compute_extent()
+        return self._max
+
+    @max.setter
+    def max(self, value):
+        self._max = value
+
+    @property
+    def x(self):
+        return self.points["x"]
+
+    @property
+    def y(self):
+        return self.points["y"]
 
-    def write(self, path):
+    @property
+    def z(self):
+        return self.points["z"]
+
+    def sort_spatial(self, curve="hilbert", cell_size=None):
+        """
+        Reorders all points **in place** along a space filling curve, so that points that are close in space are also \
+        close in memory. See spatial.curve_order for more information.
+
+        :param curve: One of "hilbert" or "morton".
+        :param cell_size: The size of the cells ordered along the curve, by default a very fine cell size is chosen.
+        """
+        order = spatial.curve_order(self.x, self.y, curve=curve, cell_size=cell_size)
+        self.points = self.points[order]
+
+    def write(self, path, curve=None):
         """
-        Writes the points and header to a .las file.
+        Writes the points and header to a .las file. Every las dimension present in self.points is written, \
+        dimensions that are not part of the las specification (i.e. those added by pyfor) are skipped.
 
         :param path: The path of the .las file to write to.
+        :param curve: If one of "hilbert" or "morton", the points are sorted along that curve (in place) before \
+        writing, see CloudData.sort_spatial.
         """
+        if curve is not None:
+            self.sort_spatial(curve=curve)
+
+        header = self.header
+        if isinstance(header, lasio.LasHeader):
+            header = laspy.file.File(header.path).header
+
         # Make header manager
-        writer = laspy.file.File(path, header = self.header, mode = "w")
-        writer.x = self.points["x"]
-        writer.y = self.points["y"]
-        writer.z = self.points["z"]
-        writer.return_num = self.points["return_num"]
-        writer.intesity = self.points["intensity"]
-        writer.classification = self.points["classification"]
-        writer.flag_byte = self.points["flag_byte"]
-        writer.scan_angle_rank = self.points["scan_angle_rank"]
-        writer.user_data = self.points["user_data"]
-        writer.pt_src_id = self.points["pt_src_id"]
+        writer = laspy.file.File(path, header = header, mode = "w")
+        for dim in lasio.LAS_DIMS:
+            if dim not in self.points:
+                continue
+            raw = self.points.raw_coordinate(dim)
+            if raw is not None and _same_scale(raw, dim, header):
+                # Scaled integer coordinates are written as is, without a round trip through floats
+                setattr(writer, dim.upper(), raw[0])
+            else:
+                setattr(writer, dim, self.points[dim])
         writer.close()
 
+    def to_pandas(self):
+        """
+        Returns the points as a pandas DataFrame, see PointStore.to_pandas.
+        """
+        return self.points.to_pandas()
+
     def _update(self):
-        self.min = [np.min(self.x), np.min(self.y), np.min(self.z)]
-        self.max = [np.max(self.x), np.max(self.y), np.max(self.z)]
-        self.count = np.alen(self.points)
+        # The count is always known, the extent is only computed if it is needed
+        self.count = len(self.points)
+        self._min = None
+        self._max = None
+
+    def _compute_extent(self):
+        if self.count == 0:
+            self._min = [np.nan, np.nan, np.nan]
+            self._max = [np.nan, np.nan, np.nan]
+            return
+        x, y, z = self.x, self.y, self.z
+        self._min = [np.min(x), np.min(y), np.min(z)]
+        self._max = [np.max(x), np.max(y), np.max(z)]
+
+    def _update_from_header(self):
+        # Avoids decoding the coordinates of lazy clouds just to find their extent
+        self.count = len(self.points)
+        self._min = list(self.header.min)
+        self._max = list(self.header.max)
+
+def _same_scale(raw, dim, header):
+    """
+    Checks that the scale and offset of raw coordinates (see PointStore.raw_coordinate) match those of a header.
+    """
+    axis = "xyz".index(dim)
+    return raw[1] == header.scale[axis] and raw[2] == header.offset[axis]
+
+def _check_dims(dims, integer_coords=False):
+    """
+    Validates a dims argument of Cloud, x y and z are always included. If integer_coords is True, x y and z are \
+    replaced by the raw integer coordinates X Y and Z.
+    """
+    if dims is None:
+        dims = DEFAULT_DIMS
+    unknown = [dim for dim in dims if dim not in lasio.LAS_DIMS]
+    if len(unknown) > 0:
+        raise ValueError("Unknown dimensions: {}".format(", ".join(unknown)))
+    coordinates = ("X", "Y", "Z") if integer_coords else ("x", "y", "z")
+    return coordinates + tuple(dim for dim in dims if dim not in ("x", "y", "z"))
+
+def _add_scaled_coordinates(points, header):
+    """
+    Registers x, y and z as scaled views of the raw integer coordinates X, Y and Z, if those are present.
+
+    :param points: A PointStore object.
+    :param header: A lasio.LasHeader or laspy header with the scale and offset of the coordinates.
+    """
+    for axis, (dim, raw) in enumerate([("x", "X"), ("y", "Y"), ("z", "Z")]):
+        if raw in points and dim not in points:
+            points.add_scaled(dim, raw, header.scale[axis], header.offset[axis])
+
+def _clipped_points(path, las, dims, bounds, polygon):
+    """
+    Reads only the points inside bounds and/or polygon. For uncompressed files the bounding box test is applied \
+    chunk by chunk while reading, only the points that pass it are decoded. If the file has an up to date spatial \
+    index (see lasindex.build_index) only the record ranges of the intersecting index cells are read.
+
+    :param path: The path to the las file.
+    :param las: The laspy File object of path.
+    :param dims: An iterable of dimension names.
+    :param bounds: A tuple of (min x, min y, max x, max y), or None.
+    :param polygon: A shapely Polygon, or None.
+    :return: A PointStore object.
+    """
+    if polygon is not None:
+        poly_bounds = polygon.bounds
+        if bounds is None:
+            bounds = poly_bounds
+        else:
+            bounds = (max(bounds[0], poly_bounds[0]), max(bounds[1], poly_bounds[1]),
+                      min(bounds[2], poly_bounds[2]), min(bounds[3], poly_bounds[3]))
+
+    header = lasio.read_header(path)
+    index = lasindex.load_index(path) if header.memmappable else None
+    if index is not None:
+        records = index.read(path, bounds, header)
+        points = PointStore(OrderedDict((dim, lasio.decode(records, dim, header)) for dim in dims))
+    elif header.memmappable:
+        records = lasio.read_clipped(path, bounds, header)
+        points = PointStore(OrderedDict((dim, lasio.decode(records, dim, header)) for dim in dims))
+    else:
+        x, y = las.x, las.y
+        keep = (x >= bounds[0]) & (x <= bounds[2]) & (y >= bounds[1]) & (y <= bounds[3])
+        points = PointStore(OrderedDict((dim, np.array(getattr(las, dim))[keep]) for dim in dims))
+
+    _add_scaled_coordinates(points, header)
+    if polygon is not None and len(points) > 0:
+        inside = clip_funcs.ray_trace(points["x"], points["y"], clip_funcs.polygon_coordinates(polygon))
+        points = points[inside]
+    return points
+
+def _lazy_points(path, las, dims):
+    """
+    Constructs a PointStore where each dimension is only decoded the first time it is accessed. Uncompressed files \
+    are memory mapped and decoded by pyfor, compressed files fall back to laspy.
+
+    :param path: The path to the las file.
+    :param las: The laspy File object of path.
+    :param dims: An iterable of dimension names.
+    :return: A PointStore object.
+    """
+    header = lasio.read_header(path)
+    if header.memmappable:
+        records = lasio.memmap_points(path, header)
+        loaders = OrderedDict((dim, partial(lasio.decode, records, dim, header)) for dim in dims)
+    else:
+        loaders = OrderedDict((dim, partial(getattr, las, dim)) for dim in dims)
+    return PointStore.lazy(loaders, header.point_records_count)
+
+def _cached_points(path, dims, cache):
+    """
+    Loads dimensions through a cache.DiskCache, only dimensions missing from the cache are decoded.
+
+    :param path: The path to the las file.
+    :param dims: An iterable of dimension names.
+    :param cache: A cache.DiskCache object.
+    :return: A PointStore object.
+    """
+    header = lasio.read_header(path)
+    if header.memmappable:
+        records = lasio.memmap_points(path, header)
+        def decode(dim):
+            return lasio.decode(records, dim, header)
+    else:
+        opened = []
+        def decode(dim):
+            if len(opened) == 0:
+                opened.append(laspy.file.File(path))
+            return np.array(getattr(opened[0], dim))
+    return cache.points(path, dims, decode)
 
 class Cloud:
     """
@@ -57,17 +256,54 @@ class Cloud:
     attributes are convenience functions for other classes and modules.
 
     :param las: One of either: a string representing the path to a las (or laz) file or a CloudData object.
+    :param lazy: If True, the point records are memory mapped and each dimension is only decoded the first time it is \
+    accessed. The minimum, maximum and count are taken from the las header.
+    :param dims: An optional list of dimension names to load, i.e. ["classification"]. x, y and z are always loaded. \
+    By default the dimensions in cloud.DEFAULT_DIMS are loaded.
+    :param bounds: An optional tuple of (min x, min y, max x, max y). If given, only the points inside the bounding \
+    box are read. This is much faster than clipping after loading, and memory use scales with the clipped area.
+    :param polygon: An optional shapely Polygon, only the points inside it are read. See bounds.
+    :param cache: An optional cache.DiskCache. Decoded dimensions are stored in the cache and memory mapped from it \
+    the next time the same file is loaded. Ignored if bounds or polygon are given.
+    :param integer_coords: If True, the coordinates are kept as the raw int32 X, Y and Z of the las file and x, y and \
+    z are computed from them with the header scale and offset on each access. This halves the memory used by the \
+    coordinates, and writing the cloud back to las is lossless.
     """
-    def __init__(self, las):
+    def __init__(self, las, lazy=False, dims=None, bounds=None, polygon=None, cache=None, integer_coords=False):
+        # Grids by cell size, see Cloud.grid
+        self._grids = {}
+        # The points as they were loaded lazily from the file, see Cloud._is_pristine_lazy
+        self._lazy_points = None
         if type(las) == str or type(las) == pathlib.PosixPath:
             self.filepath = las
+            # The loading options, used to read the file again, see Cloud.clip
+            self._dims, self._integer_coords, self._cache = dims, integer_coords, cache
+            dims = _check_dims(dims, integer_coords)
+            if cache is not None and bounds is None and polygon is None:
+                # Avoid opening the file with laspy, which decompresses laz files up front
+                header = lasio.read_header(self.filepath)
+                points = _cached_points(self.filepath, dims, cache)
+                _add_scaled_coordinates(points, header)
+                self.las = CloudData(points, header)
+                self._lazy_points = points
+                self.normalized = None
+                self.crs = None
+                return
+
             las = laspy.file.File(las)
-            # Rip points from laspy
-            points = pd.DataFrame({"x": las.x, "y": las.y, "z": las.z, "intensity": las.intensity, "return_num": las.return_num, "classification": las.classification,
-                                   "flag_byte":las.flag_byte, "scan_angle_rank":las.scan_angle_rank, "user_data": las.user_data,
-                                   "pt_src_id": las.pt_src_id})
+            if bounds is not None or polygon is not None:
+                points = _clipped_points(self.filepath, las, dims, bounds, polygon)
+            elif lazy:
+                points = _lazy_points(self.filepath, las, dims)
+            else:
+                # Rip points from laspy, each dimension is kept in its native dtype
+                points = PointStore(OrderedDict((dim, np.array(getattr(las, dim))) for dim in dims))
             header = las.header
+            _add_scaled_coordinates(points, header)
             self.las = CloudData(points, header)
+            if lazy and bounds is None and polygon is None:
+                self.las._update_from_header()
+                self._lazy_points = points
 
         elif type(las) == CloudData:
             self.las = las
@@ -78,6 +314,37 @@ class Cloud:
         self.normalized = None
         self.crs = None
 
+    @staticmethod
+    def iter_chunks(path, chunk_size=5000000, dims=None):
+        """
+        A generator that reads a las file in blocks of at most chunk_size points, each block is a CloudData object \
+        with the lasio.LasHeader of the file attached. For uncompressed files peak memory depends on chunk_size \
+        rather than the size of the file. Compressed files are decoded in full by laspy before they are split into \
+        chunks. Chunks can be written back incrementally using lasio.LasWriter.
+
+        :param path: The path to the las file.
+        :param chunk_size: The maximum number of points in each chunk.
+        :param dims: An optional list of dimension names to load, see Cloud.
+        :return: A generator of CloudData objects.
+        """
+        dims = _check_dims(dims)
+        header = lasio.read_header(path)
+
+        if header.memmappable:
+            for records in lasio.iter_records(path, chunk_size, header):
+                points = PointStore(OrderedDict((dim, lasio.decode(records, dim, header)) for dim in dims))
+                yield CloudData(points, header)
+        else:
+            las = laspy.file.File(path)
+            try:
+                columns = OrderedDict((dim, np.array(getattr(las, dim))) for dim in dims)
+                for start in range(0, header.point_records_count, chunk_size):
+                    points = PointStore(OrderedDict((dim, values[start:start + chunk_size])
+                                                    for dim, values in columns.items()))
+                    yield CloudData(points, header)
+            finally:
+                las.close()
+
     def __str__(self):
         """
         Returns a human readable summary of the Cloud object.
@@ -112,24 +379,30 @@ class Cloud:
         integers. Used to produce clearer 3d visualizations of detected trees.
 
         :param n_bin: Number of bins to reduce to.
-        :param series: The pandas series to reduce, usually 'user_data' which is set to a unique tree ID after detection.
+        :param series: The array to reduce, usually 'user_data' which is set to a unique tree ID after detection.
         """
 
-        random_ints = np.random.randint(1, n_bin + 1, size = len(np.unique(series)))
-        pre_merge = pd.DataFrame({'unique_id': series.unique(), 'random_id': random_ints})
-
-
-        self.las.points = pd.merge(self.las.points, pre_merge, left_on = 'user_data', right_on = 'unique_id')
+        unique_ids, inverse = np.unique(series, return_inverse=True)
+        random_ints = np.random.randint(1, n_bin + 1, size = len(unique_ids))
+        self.las.points['random_id'] = random_ints[inverse]
 
     def grid(self, cell_size):
         """
         Generates a Grid object for this Cloud given a cell size. The Grid is generally used to compute Raster objects
         See the documentation for Grid for more information.
 
+        Grids are memoized by cell size together with the rasters computed on them, so repeated calls at the same cell \
+        size (i.e. Cloud.chm) reuse the binning. A new Grid is built once the points are filtered, clipped, \
+        normalized or otherwise replaced.
+
         :param cell_size: The resolution of the plot in the same units as the input file.
         :return: A Grid object.
         """
-        return(rasterizer.Grid(self, cell_size))
+        # Stale grids are dropped to release their indices
+        self._grids = {size: grid for size, grid in self._grids.items() if grid.is_current}
+        if cell_size not in self._grids:
+            self._grids[cell_size] = rasterizer.Grid(self, cell_size)
+        return(self._grids[cell_size])
 
     def plot(self, cell_size = 1, cmap = "viridis", return_plot = False, block=False):
         """
@@ -142,7 +415,7 @@ class Cloud:
         :return: If return_plot == True, returns matplotlib plt object. Not yet implemented.
         """
 
-        rasterizer.Grid(self, cell_size).raster("max", "z").plot(cmap, block = block, return_plot = return_plot)
+        self.grid(cell_size).raster("max", "z").plot(cmap, block = block, return_plot = return_plot)
 
     def iplot3d(self, max_points=30000, point_size=0.5, dim="z", colorscale="Viridis"):
         """
@@ -184,11 +457,11 @@ class Cloud:
                                                 size = int(max_points))
                 coordinates = np.stack([self.las.points.x, self.las.points.y, self.las.points.z], axis = 1)[sample_mask,:]
 
-                color_dim = np.copy(self.las.points[dim].iloc[sample_mask].values)
+                color_dim = np.copy(self.las.points[dim][sample_mask])
                 print("Too many points, down sampling for 3d plot performance.")
         else:
             coordinates = np.stack([self.las.points.x, self.las.points.y, self.las.points.z], axis = 1)
-            color_dim = np.copy(self.las.points[dim].values)
+            color_dim = np.copy(self.las.points[dim])
 
         # If dim is user data (probably TREE ID or some such thing) then we want a discrete colormap
         if dim != 'random_id':
@@ -220,7 +493,8 @@ class Cloud:
         #return(view.opts)
         view.show()
 
-    def normalize(self, cell_size, num_windows=7, dh_max=2.5, dh_0=1, interp_method="nearest"):
+    def normalize(self, cell_size, num_windows=7, dh_max=2.5, dh_0=1, interp_method="nearest", sampling="nearest",
+                  method="zhang"):
         """
         Normalizes this cloud object **in place** by generating a DEM using the default filtering algorithm  and \
         subtracting the underlying ground elevation. This uses a grid-based progressive morphological filter developed \
@@ -243,43 +517,196 @@ class Cloud:
         :param dh_0: The null height threshold.
         :param interp_method: The interpolation method used to fill in missing values after the ground filtering \
         takes place. One of any: "nearest", "linear", or "cubic".
+        :param sampling: How the ground elevation of each point is taken from the DEM, either "nearest", the value of \
+        the cell that contains the point, or "bilinear", interpolated between the four closest cell centers.
+        :param method: The ground filter, "zhang" or "csf" (a cloth simulation, Zhang et al. 2016), see \
+        Grid.ground_filter.
         """
+        if self.normalized == True:
+            print("It appears this has already been normalized once. Proceeding with normalization but expect \
+            strange results.")
+
         grid = self.grid(cell_size)
-        dem_grid = grid.normalize(num_windows, dh_max, dh_0, interp_method)
+        dem = grid.ground_filter(num_windows, dh_max, dh_0, interp_method, method=method)
+        self._subtract_ground(grid.ground_elevation(dem.array, sampling))
+
+    def classify_ground(self, cell_size, num_windows=7, dh_max=2.5, dh_0=1, interp_method="nearest",
+                        threshold=0.5, sampling="bilinear", method="zhang"):
+        """
+        Classifies the points of this cloud object as ground **in place**. A DEM is built with the default filtering \
+        algorithm (see Cloud.normalize), and every point within threshold of the DEM is set to class 2 (ground). \
+        Points that were previously classified as ground but are further than threshold from the DEM are set to \
+        class 1 (unclassified), all other classes are left as they are. Use CloudData.write to save the classified \
+        points.
+
+        The DEM is memoized by the grid until z changes, so calling Cloud.normalize afterwards with the same \
+        arguments reuses it. Classify before normalizing, normalizing modifies z and the DEM would be recomputed \
+        from the normalized heights.
+
+        :param cell_size: The cell_size at which to rasterize the point cloud into bins, in the same units as the \
+        input point cloud.
+        :param num_windows: The number of windows to consider.
+        :param dh_max: The maximum height threshold.
+        :param dh_0: The null height threshold.
+        :param interp_method: The interpolation method used to fill in missing values of the DEM.
+        :param threshold: The maximum distance above or below the DEM of a ground point.
+        :param sampling: How the ground elevation of each point is taken from the DEM, "bilinear" or "nearest".
+        :param method: The ground filter, "zhang" or "csf", see Grid.ground_filter.
+        :return: A boolean mask of the ground points.
+        """
+        grid = self.grid(cell_size)
+        dem = grid.ground_filter(num_windows, dh_max, dh_0, interp_method, method=method)
+        if dem.array is None:
+            raise ValueError("No ground cells were found, try different filter parameters.")
+        height = self.las.points["z"] - grid.ground_elevation(dem.array, sampling)
+        ground = np.abs(height) <= threshold
+        self._set_ground(ground)
+        return ground
+
+    def _set_ground(self, ground):
+        """
+        Sets the classification of the points in the boolean mask ground to 2 and of the other points classified as \
+        2 to 1.
+        """
+        points = self.las.points
+        if "classification" in points:
+            classification = np.array(points["classification"], dtype=np.uint8)
+        else:
+            classification = np.zeros(len(points), dtype=np.uint8)
+        classification[(classification == 2) & ~ground] = 1
+        classification[ground] = 2
+        points["classification"] = classification
+
+    def normalize_with(self, dem, sampling="bilinear"):
+        """
+        Normalizes this cloud object **in place** against an existing DEM, i.e. one produced once for a large block \
+        with Grid.ground_filter and written with Raster.write. The DEM may have any resolution, the ground elevation \
+        is sampled at each point. For GeoTIFFs only the window of the DEM that covers the cloud is read.
+
+        :param dem: A Raster object, a terrain.TerrainModel or the path of a single band GeoTIFF, in the same CRS as \
+        the cloud.
+        :param sampling: Either "bilinear" (default), interpolated between the four closest cell centers, or \
+        "nearest", the value of the cell that contains the point. Not used for TerrainModels, which interpolate on \
+        their triangulation.
+        """
+        points = self.las.points
+        if isinstance(dem, TerrainModel):
+            self._subtract_ground(dem.sample(points["x"], points["y"]))
+            return
 
-        self.las.points['z'] = dem_grid.data['z']
-        self.las.min = [np.min(dem_grid.data.x), np.min(dem_grid.data.y), np.min(dem_grid.data.z)]
-        self.las.max = [np.max(dem_grid.data.x), np.max(dem_grid.data.y), np.max(dem_grid.data.z)]
+        if isinstance(dem, rasterizer.Raster):
+            array, min_x, min_y, cell_size = dem.array, dem.grid.las.min[0], dem.grid.las.min[1], dem.cell_size
+        else:
+            bounds = (self.las.min[0], self.las.min[1], self.las.max[0], self.las.max[1])
+            array, min_x, min_y, cell_size = gisexport.read_raster_window(str(dem), bounds)
+
+        ground = interpolation.sample(array, points["x"], points["y"], min_x, min_y, cell_size, sampling)
+        self._subtract_ground(ground)
+
+    def _subtract_ground(self, ground):
+        """
+        Subtracts the ground elevation of each point from z, in place where possible so that no copy of z is made. \
+        z memory mapped from a cache.DiskCache is copy on write, so it is also modified in place without changing \
+        the cache.
+        """
+        z = self.las.points["z"]
+        # Arrays shared with a clipped cloud are not modified, see PointStore.is_shared
+        owned = (isinstance(z, np.memmap) or z.flags.owndata) and z.flags.writeable and \
+                not self.las.points.is_shared("z")
+        if owned and z.dtype.kind == "f" and self.las.points.raw_coordinate("z") is None:
+            np.subtract(z, ground, out=z)
+        else:
+            z = z - ground
+        # Assigning z marks the memoized rasters of z as stale
+        self.las.points["z"] = z
+        self.las._update()
         self.normalized = True
 
+    @property
+    def _is_pristine_lazy(self):
+        """
+        True if this Cloud was loaded lazily or from a cache.DiskCache and its points have not been filtered, \
+        clipped, sorted or assigned to since. Modifying a dimension array in place is not detected.
+        """
+        points = self.las.points
+        return points is self._lazy_points and not any(points.version(dim) for dim in points)
+
     def clip(self, poly):
         """
-        Clips the point cloud to the provided shapely polygon using a ray casting algorithm.
+        Clips the point cloud to the provided shapely polygon using a ray casting algorithm. To extract a small area \
+        from a large file, consider Cloud(path, polygon=poly) instead, which avoids loading the whole file.
 
         :param poly: A shapely polygon in the same CRS as the Cloud.
         :return: A new cloud object clipped to the provided polygon.
         """
         #TODO Implement geopandas for multiple clipping polygons.
 
+        # A lazy cloud that has not been touched yet can be clipped while reading, using the spatial index if present
+        if self._is_pristine_lazy:
+            new_cloud = Cloud(self.filepath, dims=self._dims, polygon=poly, cache=self._cache,
+                              integer_coords=self._integer_coords)
+            new_cloud.crs = self.crs
+            return(new_cloud)
+
         keep = clip_funcs.poly_clip(self, poly)
-        # Create copy to avoid warnings
-        keep_points = self.las.points.iloc[keep].copy()
+        keep_points = self.las.points.select(keep)
         new_cloud =  Cloud(CloudData(keep_points, self.las.header))
         new_cloud.las._update()
         return(new_cloud)
 
+    def polygon_metrics(self, polygons, metrics=None, dim="z", cover_threshold=2):
+        """
+        Computes area based metrics of the points inside each polygon, i.e. for field plots. All polygons are \
+        processed in one pass, the points are bucketed once and each polygon only tests nearby points, which is much \
+        faster than calling Cloud.clip for each polygon. See metrics.group_metrics for the metric definitions.
+
+        :param polygons: A geopandas GeoDataFrame or GeoSeries of polygons in the same CRS as the Cloud.
+        :param metrics: An optional list of metric names, see metrics.metric_names. Percentiles are named by "p" and \
+        the percentile, i.e. "p95". By default the standard set is computed.
+        :param dim: The dimension to compute the metrics on.
+        :param cover_threshold: The cover metric is the proportion of first returns above this value.
+        :return: A pandas DataFrame with one row per polygon, with the same index as polygons. Polygons without points \
+        have a count of 0 and nan for every other metric.
+        """
+        if metrics is None:
+            percentiles = DEFAULT_PERCENTILES
+            metrics = metric_names(percentiles)
+        else:
+            percentiles = [int(name[1:]) for name in metrics if name[0] == "p" and name[1:].isdigit()]
+            unknown = set(metrics) - set(metric_names(percentiles))
+            if len(unknown) > 0:
+                raise ValueError("Unknown metrics: {}".format(", ".join(sorted(unknown))))
+
+        geometries = getattr(polygons, "geometry", polygons)
+        points = self.las.points
+        point_ids, polygon_ids = clip_funcs.polygon_membership(points["x"], points["y"], geometries)
+
+        cover_mask = None
+        if "return_num" in points or "flag_byte" in points:
+            cover_mask = rasterizer._return_mask(points, "first")[point_ids]
+        groups, values = group_metrics(polygon_ids, np.asarray(points[dim])[point_ids], percentiles,
+                                       cover_threshold, cover_mask)
+
+        frame = pd.DataFrame(np.nan, index=polygons.index, columns=metrics)
+        for name in metrics:
+            frame.iloc[groups, frame.columns.get_loc(name)] = values[name]
+        if "count" in frame:
+            frame["count"] = frame["count"].fillna(0).astype(np.int64)
+        return frame
+
     def filter(self, min, max, dim):
         """
-        Filters a cloud object for a given dimension **in place**.
+        Filters a cloud object for a given dimension **in place**. No dimension is copied until it is read, so a chain \
+        of filters only gathers each dimension once.
 
         :param min: Minimum dimension to retain.
         :param max: Maximum dimension to retain.
-        :param dim: The dimension of interest as a string. For example "z". This corresponds to a column label in \
-        self.las.points dataframe.
+        :param dim: The dimension of interest as a string. For example "z". This corresponds to a dimension name in \
+        self.las.points.
         """
-        condition = (self.las.points[dim] > min) & (self.las.points[dim] < max)
-        self.las = CloudData(self.las.points[condition], self.las.header)
-        self.las._update()
+        values = self.las.points[dim]
+        condition = (values > min) & (values < max)
+        self.las = CloudData(self.las.points.select(condition), self.las.header)
 
     def chm(self, cell_size, interp_method=None, pit_filter=None, kernel_size=3):
         """
@@ -288,10 +715,20 @@ class Cloud:
         :param cell_size: The cell size for the returned raster in the same units as the parent Cloud or las file.
         :param interp_method: The interpolation method to fill in NA values of the produced canopy height model, one \
         of either "nearest", "cubic", or "linear"
-        :param pit_filter: If "median" passes a median filter over the produced canopy height model.
+        :param pit_filter: If "median" passes a median filter over the produced canopy height model. If "pit_free" \
+        the canopy height model is built from layered triangulations of the first returns instead of the maximum z \
+        value, see Grid.pit_free_chm. The cloud should be normalized first, a warning is printed otherwise.
         :param kernel_size: The kernel size of the median filter, must be an odd integer.
         :return: A Raster object of the canopy height model.
         """
+        if pit_filter == "pit_free":
+            if self.normalized != True:
+                print("Warning: the layer thresholds of the pit free canopy height model are heights above ground, \
+                but this cloud has not been normalized with Cloud.normalize.")
+            raster = self.grid(cell_size).pit_free_chm()
+            if interp_method is not None:
+                raster.array = interpolation.fill_nan(raster.array, interp_method)
+            return raster
 
         if pit_filter == "median":
             raster = self.grid(cell_size).interpolate("max", "z", interp_method=interp_method)
@@ -320,12 +757,24 @@ class Cloud:
 
         return gpd.GeoSeries(hull_poly)
 
-    def write(self, path):
+    def sort_spatial(self, curve="hilbert", cell_size=None):
+        """
+        Reorders the points of this Cloud **in place** along a space filling curve. Spatially sorted clouds are \
+        faster to grid, clip and cluster as neighbouring points are also neighbours in memory.
+
+        :param curve: One of "hilbert" or "morton".
+        :param cell_size: The size of the cells ordered along the curve, in the same units as the cloud. By default a \
+        very fine cell size is chosen.
+        """
+        self.las.sort_spatial(curve=curve, cell_size=cell_size)
+
+    def write(self, path, curve=None):
         """
         Write the Cloud to a las file.
 
         :param path: The path of the output file.
+        :param curve: If one of "hilbert" or "morton", sorts the points along that curve before writing.
         :return:
         """
-        self.las.write(path)
+        self.las.write(path, curve=curve)
 
@@ -1,5 +1,8 @@
 import pathlib
 import laspy
+from pyfor import lasio
+from pyfor import lasindex
+from pyfor import pointstore
 
 class Collection:
     """
@@ -11,7 +14,8 @@ class Collection:
     """
     def __init__(self, las_dir):
         self.las_dir = las_dir
-        self.las_paths = [filepath.absolute() for filepath in pathlib.Path(self.las_dir).glob('**/*')]
+        self.las_paths = [filepath.absolute() for filepath in pathlib.Path(self.las_dir).glob('**/*')
+                          if filepath.suffix.lower() in (".las", ".laz")]
 
     @property
     def _las_objects(self):
@@ -24,7 +28,56 @@ class Collection:
     @property
     def las_headers(self):
         """
-        Returns a list of las headers.
+        Returns a list of las headers. Only the public header block of each file is read, the files are not kept open.
+
+        Since 0.3 these are lasio.LasHeader objects rather than laspy headers. They have the laspy names of the \
+        fields pyfor uses, i.e. file_signature, version, version_major, version_minor, point_records_count, \
+        data_format_id, data_record_length, header_size, data_offset, num_variable_len_recs, scale, offset, min and \
+        max. Other laspy header attributes are not available, use Collection._las_objects for those.
         """
-        #FIXME laspy breaks with a large number of files
-        return [las_obj.header for las_obj in self._las_objects]
\ No newline at end of file
+        return [lasio.read_header(las_file) for las_file in self.las_paths]
+
+    def clouds(self, lazy=True):
+        """
+        A generator of Cloud objects, one for each las file in the collection.
+
+        :param lazy: If True (default), each cloud is opened lazily, see Cloud for more information.
+        """
+        from pyfor.cloud import Cloud
+        for las_file in self.las_paths:
+            yield Cloud(las_file, lazy=lazy)
+
+    def build_index(self, cell_size=None):
+        """
+        Builds the spatial index of each uncompressed las file in the collection, see lasindex.build_index. Indexed \
+        files are used automatically by Collection.clip and Cloud(path, polygon=...).
+
+        :param cell_size: The size of the index cells, by default each file is divided into 100 x 100 cells.
+        """
+        for las_file, header in zip(self.las_paths, self.las_headers):
+            if header.memmappable:
+                lasindex.build_index(las_file, cell_size=cell_size)
+
+    def clip(self, poly):
+        """
+        Clips the points of every las file in the collection to a polygon. Files are skipped using their header \
+        bounds, and only the points inside the polygon are read from the remaining files.
+
+        :param poly: A shapely polygon in the same CRS as the collection.
+        :return: A Cloud object of the points inside the polygon.
+        """
+        from pyfor.cloud import Cloud, CloudData
+        bounds = poly.bounds
+        clouds = []
+        for las_file, header in zip(self.las_paths, self.las_headers):
+            if bounds[0] > header.max[0] or bounds[2] < header.min[0] or bounds[1] > header.max[1] or \
+                    bounds[3] < header.min[1]:
+                continue
+            clipped = Cloud(las_file, polygon=poly)
+            if clipped.las.count > 0:
+                clouds.append(clipped)
+
+        if len(clouds) == 0:
+            raise ValueError("The polygon does not intersect any points in the collection.")
+        points = pointstore.concat([clipped.las.points for clipped in clouds])
+        return Cloud(CloudData(points, clouds[0].las.header))
@@ -39,7 +39,7 @@ class LayerStacking:
 
         # Meta Information
         self.cloud = cloud
-        self.points = self.cloud.las.points
+        self.points = self.cloud.las.points.to_pandas()
         self.chm = self.cloud.chm(chm_resolution, interp_method= "nearest", pit_filter= "median")
 
         # Algorithm parameters
@@ -16,15 +16,14 @@ def project_indices(indices, raster):
     """
 
     seed_xy = indices[:,1] + (raster._affine[2] / raster._affine[0]), \
-              indices[:,0] + (raster._affine[5] - (raster.grid.las.max[1] - raster.grid.las.min[1]) /
-                              abs(raster._affine[4]))
+              indices[:,0] + (raster._affine[5] - raster.grid.m * raster.grid.cell_size) / abs(raster._affine[4])
     seed_xy = np.stack(seed_xy, axis = 1)
     return(seed_xy)
 
 def array_to_raster(array, pixel_size, x_min, y_max, wkt, path):
     """Writes a GeoTIFF raster from a numpy array.
 
-    :param array: 2D numpy array of cell values
+    :param array: 2D numpy array of cell values, or a 3D numpy array of shape (bands, rows, columns)
     :param pixel_size: -- Desired resolution of the output raster, in same units as wkt projection.
     :param x_min: Minimum x coordinate (top left corner of raster)
     :param y_max: Maximum y coordinate
@@ -32,15 +31,50 @@ def array_to_raster(array, pixel_size, x_min, y_max, wkt, path):
     :param path: The output bath of the GeoTIFF
     """
     # First flip the array
-    array = np.flipud(array)
+    bands = array if array.ndim == 3 else array[np.newaxis]
+    bands = bands[:, ::-1, :]
 
     transform = rasterio.transform.from_origin(x_min, y_max, pixel_size, pixel_size)
-    out_dataset = rasterio.open(path, 'w', driver='GTiff', height=array.shape[0], width = array.shape[1], count=1,
-                                dtype=str(array.dtype),crs=wkt, transform=transform)
+    out_dataset = rasterio.open(path, 'w', driver='GTiff', height=bands.shape[1], width = bands.shape[2],
+                                count=bands.shape[0], dtype=str(bands.dtype),crs=wkt, transform=transform)
 
-    out_dataset.write(array, 1)
+    out_dataset.write(np.ascontiguousarray(bands))
     out_dataset.close()
 
+def read_raster_window(path, bounds, padding=1):
+    """
+    Reads the cells of the first band of a north up raster file that cover a bounding box, plus a margin of padding \
+    cells where available. nodata cells are returned as nan.
+
+    :param path: The path of the raster, i.e. a GeoTIFF.
+    :param bounds: A tuple of (min x, min y, max x, max y).
+    :param padding: The number of cells to read beyond the bounding box on each side.
+    :return: A tuple of the 2D float64 array oriented as pyfor Rasters (row 0 is the southern edge), the x \
+    coordinate of its western edge, the y coordinate of its southern edge and a tuple of the (x, y) cell sizes.
+    """
+    from rasterio.windows import Window
+    with rasterio.open(path) as source:
+        transform = source.transform
+        if transform.b != 0 or transform.d != 0:
+            raise ValueError("Only north up rasters are supported.")
+        size_x, size_y = transform.a, -transform.e
+
+        col_min = int(np.floor((bounds[0] - transform.c) / size_x)) - padding
+        col_max = int(np.floor((bounds[2] - transform.c) / size_x)) + padding
+        row_min = int(np.floor((transform.f - bounds[3]) / size_y)) - padding
+        row_max = int(np.floor((transform.f - bounds[1]) / size_y)) + padding
+        col_min, row_min = max(col_min, 0), max(row_min, 0)
+        col_max, row_max = min(col_max, source.width - 1), min(row_max, source.height - 1)
+        if col_min > col_max or row_min > row_max:
+            raise ValueError("The raster does not overlap the bounding box.")
+
+        window = Window(col_min, row_min, col_max - col_min + 1, row_max - row_min + 1)
+        array = source.read(1, window=window, masked=True).astype(np.float64).filled(np.nan)
+
+    min_x = transform.c + col_min * size_x
+    min_y = transform.f - (row_max + 1) * size_y
+    return(np.flipud(array), min_x, min_y, (size_x, size_y))
+
 def array_to_polygons(array, affine=None):
     """
     Returns a geopandas dataframe of polygons as deduced from an array.
@@ -0,0 +1,115 @@
+# Functions for filling the missing cells of rasters.
+
+import numpy as np
+from scipy.ndimage import binary_dilation, distance_transform_edt
+from scipy.spatial import Delaunay
+from scipy.interpolate import LinearNDInterpolator, CloughTocher2DInterpolator
+
+def fill_nan(array, method="nearest", max_distance=None, hull=False):
+    """
+    Fills the nan cells of a 2D array from its other cells. Only the nan cells are evaluated, so the cost depends \
+    on the number of missing cells rather than the size of the array.
+
+    "nearest" takes the value of the closest cell using a Euclidean distance transform. "linear" and "cubic" \
+    interpolate on a Delaunay triangulation (TIN) of the centers of the cells with values, as scipy.griddata does, \
+    so cells outside of their convex hull stay nan. For "linear" only the cells that border an empty cell or the edge \
+    of the array are triangulated, which gives the same triangles around the empty cells. Where four cell centers \
+    are on a circle either diagonal is a valid triangulation, so results may differ from scipy.griddata there. \
+    "cubic" estimates gradients from every cell, so all cells are triangulated.
+
+    :param array: A 2D numpy array.
+    :param method: One of "nearest", "linear" or "cubic".
+    :param max_distance: An optional distance, in cells. Cells further than this from any cell with a value stay nan.
+    :param hull: If True, cells outside of the convex hull of the cells with values stay nan, also for "nearest".
+    :return: A new 2D numpy array.
+    """
+    if method not in ("nearest", "linear", "cubic"):
+        raise ValueError("method must be one of 'nearest', 'linear' or 'cubic'.")
+
+    array = np.asarray(array, dtype=np.float64)
+    missing = np.isnan(array)
+    filled = array.copy()
+    if not missing.any() or missing.all():
+        return filled
+
+    distances = None
+    if method == "nearest" or max_distance is not None:
+        distances, (rows, cols) = distance_transform_edt(missing, return_indices=True)
+
+    targets = missing
+    if max_distance is not None:
+        targets = targets & (distances <= max_distance)
+    target_rows, target_cols = np.nonzero(targets)
+    target_xy = np.stack((target_rows, target_cols), axis=1)
+
+    tin = None
+    if method != "nearest" or hull:
+        known = ~missing
+        if method != "cubic":
+            # Only cells that border an empty cell or the edge of the array can be vertices of the triangles that
+            # cover empty cells or of the convex hull, the other cells are left out of the triangulation
+            edge = np.zeros(array.shape, dtype=bool)
+            edge[0, :] = edge[-1, :] = edge[:, 0] = edge[:, -1] = True
+            known &= binary_dilation(missing, structure=np.ones((3, 3))) | edge
+        known_rows, known_cols = np.nonzero(known)
+        known_xy = np.stack((known_rows, known_cols), axis=1)
+        try:
+            tin = Delaunay(known_xy)
+        except (ValueError, RuntimeError):
+            # Too few or collinear cells to triangulate, nothing can be interpolated inside a hull
+            return filled
+
+    if method == "nearest":
+        values = array[rows[targets], cols[targets]]
+        if hull:
+            values[tin.find_simplex(target_xy) < 0] = np.nan
+    elif method == "linear":
+        values = LinearNDInterpolator(tin, array[known])(target_xy)
+    else:
+        values = CloughTocher2DInterpolator(tin, array[known])(target_xy)
+
+    filled[target_rows, target_cols] = values
+    return filled
+
+def sample(array, x, y, min_x, min_y, cell_size, method="nearest"):
+    """
+    Samples a raster at point coordinates. The array is oriented as the arrays of pyfor Rasters, row 0 is the \
+    southern edge, and each cell covers [min + i * cell_size, min + (i + 1) * cell_size). Points outside of the array \
+    take the value of the closest edge cell.
+
+    :param array: A 2D numpy array.
+    :param x: A 1D numpy array of x coordinates.
+    :param y: A 1D numpy array of y coordinates.
+    :param min_x: The x coordinate of the western edge of the array.
+    :param min_y: The y coordinate of the southern edge of the array.
+    :param cell_size: The size of the cells, or a tuple of the (x, y) sizes of the cells.
+    :param method: Either "nearest", the value of the cell that contains each point, or "bilinear", interpolated \
+    between the centers of the four closest cells. Where a bilinear neighbour is nan the nearest value is used.
+    :return: A 1D numpy array of the sampled values.
+    """
+    size_x, size_y = (cell_size, cell_size) if np.isscalar(cell_size) else cell_size
+    rows, cols = array.shape
+    col = (np.asarray(x) - min_x) / size_x
+    row = (np.asarray(y) - min_y) / size_y
+
+    nearest_col = np.clip(np.floor(col), 0, cols - 1).astype(np.int64)
+    nearest_row = np.clip(np.floor(row), 0, rows - 1).astype(np.int64)
+    nearest = array[nearest_row, nearest_col]
+    if method == "nearest":
+        return nearest
+    if method != "bilinear":
+        raise ValueError("method must be one of 'nearest' or 'bilinear'.")
+
+    # Positions relative to the cell centers
+    col = np.clip(col - 0.5, 0, cols - 1)
+    row = np.clip(row - 0.5, 0, rows - 1)
+    col_0 = np.minimum(np.floor(col).astype(np.int64), max(cols - 2, 0))
+    row_0 = np.minimum(np.floor(row).astype(np.int64), max(rows - 2, 0))
+    col_1 = np.minimum(col_0 + 1, cols - 1)
+    row_1 = np.minimum(row_0 + 1, rows - 1)
+    dx = col - col_0
+    dy = row - row_0
+
+    values = (array[row_0, col_0] * (1 - dx) + array[row_0, col_1] * dx) * (1 - dy) + \
+             (array[row_1, col_0] * (1 - dx) + array[row_1, col_1] * dx) * dy
+    return np.where(np.isnan(values), nearest, values)
@@ -0,0 +1,209 @@
+# A persistent spatial index of las files, stored in a sidecar file next to the las file.
+
+import os
+import numpy as np
+from pyfor import lasio
+
+# The extension of index files, tile.las is indexed by tile.pfx
+INDEX_EXTENSION = ".pfx"
+
+def index_path(las_path):
+    """
+    Returns the path of the index file of a las file.
+    """
+    return os.path.splitext(str(las_path))[0] + INDEX_EXTENSION
+
+class LasIndex:
+    """
+    A cell table of point ranges for a las file, similar to a LAStools .lax file. The extent of the file is divided \
+    into square cells, and each cell stores the (start, end) record ranges that contain its points. A spatial query \
+    then only reads the record ranges of the intersecting cells.
+
+    LasIndex objects are usually created with build_index and read with load_index rather than directly.
+
+    :param cell_size: The size of the cells, in the units of the las file.
+    :param origin: A tuple of the (min x, min y) of the indexed file.
+    :param shape: A tuple of the (rows, columns) of the cell table.
+    :param cell_ptr: A 1D array of length rows * columns + 1, the intervals of cell i are cell_ptr[i]:cell_ptr[i+1].
+    :param starts: A 1D array of the first record of each interval.
+    :param ends: A 1D array of the record after the last record of each interval.
+    :param source_size: The size in bytes of the indexed las file, used to detect stale indices.
+    :param source_mtime: The modification time of the indexed las file, used to detect stale indices.
+    """
+    def __init__(self, cell_size, origin, shape, cell_ptr, starts, ends, source_size, source_mtime):
+        self.cell_size = cell_size
+        self.origin = origin
+        self.shape = shape
+        self.cell_ptr = cell_ptr
+        self.starts = starts
+        self.ends = ends
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+
+    @property
+    def n_intervals(self):
+        return len(self.starts)
+
+    def is_valid_for(self, las_path):
+        """
+        Checks that the las file has not changed since the index was built.
+        """
+        stat = os.stat(str(las_path))
+        return stat.st_size == self.source_size and stat.st_mtime == self.source_mtime
+
+    def save(self, path):
+        """
+        Writes the index to disk.
+
+        :param path: The path of the index file.
+        """
+        with open(str(path), "wb") as index_file:
+            np.savez(index_file, cell_size=self.cell_size, origin=self.origin, shape=self.shape,
+                     cell_ptr=self.cell_ptr, starts=self.starts, ends=self.ends,
+                     source=np.array([self.source_size, self.source_mtime], dtype=np.float64))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index from disk.
+
+        :param path: The path of the index file.
+        :return: A LasIndex object.
+        """
+        with np.load(str(path)) as arrays:
+            source = arrays["source"]
+            return cls(float(arrays["cell_size"]), tuple(float(v) for v in arrays["origin"]),
+                       tuple(int(v) for v in arrays["shape"]),
+                       arrays["cell_ptr"], arrays["starts"], arrays["ends"], int(source[0]), float(source[1]))
+
+    def query(self, bounds):
+        """
+        Finds the record ranges that may contain points inside a bounding box.
+
+        :param bounds: A tuple of (min x, min y, max x, max y).
+        :return: A tuple of two 1D arrays, the sorted and non overlapping starts and ends of the record ranges.
+        """
+        rows, cols = self.shape
+        col_min = max(int(np.floor((bounds[0] - self.origin[0]) / self.cell_size)), 0)
+        row_min = max(int(np.floor((bounds[1] - self.origin[1]) / self.cell_size)), 0)
+        col_max = min(int(np.floor((bounds[2] - self.origin[0]) / self.cell_size)), cols - 1)
+        row_max = min(int(np.floor((bounds[3] - self.origin[1]) / self.cell_size)), rows - 1)
+        if col_min > col_max or row_min > row_max:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        row_ids, col_ids = np.mgrid[row_min:row_max + 1, col_min:col_max + 1]
+        cells = (row_ids * cols + col_ids).ravel()
+        interval_ids = np.concatenate([np.arange(self.cell_ptr[cell], self.cell_ptr[cell + 1]) for cell in cells])
+        if len(interval_ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return _merge_intervals(self.starts[interval_ids], self.ends[interval_ids])
+
+    def read(self, las_path, bounds, header=None):
+        """
+        Reads only the point records inside a bounding box, using the index to skip record ranges outside of it.
+
+        :param las_path: The path of the indexed las file.
+        :param bounds: A tuple of (min x, min y, max x, max y).
+        :param header: An optional lasio.LasHeader of the file.
+        :return: A structured numpy array of point records.
+        """
+        if header is None:
+            header = lasio.read_header(las_path)
+        starts, ends = self.query(bounds)
+        if len(starts) == 0:
+            return np.zeros(0, dtype=header.dtype)
+
+        records = lasio.memmap_points(las_path, header)
+        candidates = np.concatenate([records[start:end] for start, end in zip(starts, ends)])
+        return candidates[lasio.in_bounds(candidates, lasio.raw_bounds(header, bounds))]
+
+def _merge_intervals(starts, ends):
+    """
+    Sorts intervals and merges those that overlap or touch.
+    """
+    order = np.argsort(starts, kind="mergesort")
+    starts, ends = starts[order], ends[order]
+    running_end = np.maximum.accumulate(ends)
+    # A new interval begins wherever a start is past the furthest end seen so far
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > running_end[:-1]
+    group = np.cumsum(new) - 1
+    merged_ends = np.zeros(group[-1] + 1, dtype=ends.dtype)
+    np.maximum.at(merged_ends, group, ends)
+    return starts[new], merged_ends
+
+def build_index(las_path, cell_size=None, chunk_size=5000000, save=True):
+    """
+    Builds the spatial index of an uncompressed las file in a single chunked pass. Consecutive points that fall in \
+    the same cell are stored as one record range, so the index is small for files in acquisition or spatial order.
+
+    :param las_path: The path of the las file.
+    :param cell_size: The size of the index cells in the units of the las file. By default the longest side of the \
+    extent is divided into 100 cells.
+    :param chunk_size: The number of records to read at a time.
+    :param save: If True, the index is written next to the las file, see index_path.
+    :return: A LasIndex object.
+    """
+    header = lasio.read_header(las_path)
+    origin = (header.min[0], header.min[1])
+    if cell_size is None:
+        cell_size = max(header.max[0] - header.min[0], header.max[1] - header.min[1]) / 100
+        cell_size = cell_size if cell_size > 0 else 1
+    rows = int(np.floor((header.max[1] - origin[1]) / cell_size)) + 1
+    cols = int(np.floor((header.max[0] - origin[0]) / cell_size)) + 1
+
+    all_cells, all_starts, all_ends = [], [], []
+    offset = 0
+    for records in lasio.iter_records(las_path, chunk_size, header):
+        x = lasio.decode(records, "x", header)
+        y = lasio.decode(records, "y", header)
+        col = np.clip(np.floor((x - origin[0]) / cell_size).astype(np.int64), 0, cols - 1)
+        row = np.clip(np.floor((y - origin[1]) / cell_size).astype(np.int64), 0, rows - 1)
+        cells = row * cols + col
+
+        # Run length encode the cell of consecutive points
+        run_starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        run_ends = np.r_[run_starts[1:], len(cells)]
+        all_cells.append(cells[run_starts])
+        all_starts.append(run_starts + offset)
+        all_ends.append(run_ends + offset)
+        offset += len(records)
+
+    cells = np.concatenate(all_cells) if all_cells else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(all_starts) if all_starts else np.zeros(0, dtype=np.int64)
+    ends = np.concatenate(all_ends) if all_ends else np.zeros(0, dtype=np.int64)
+
+    # Sort by cell and then merge ranges of the same cell that touch (i.e. across chunk boundaries)
+    order = np.lexsort((starts, cells))
+    cells, starts, ends = cells[order], starts[order], ends[order]
+    if len(cells) > 0:
+        new = np.r_[True, (cells[1:] != cells[:-1]) | (starts[1:] != ends[:-1])]
+        group = np.cumsum(new) - 1
+        merged_ends = np.zeros(group[-1] + 1, dtype=ends.dtype)
+        np.maximum.at(merged_ends, group, ends)
+        cells, starts, ends = cells[new], starts[new], merged_ends
+
+    cell_ptr = np.zeros(rows * cols + 1, dtype=np.int64)
+    cell_ptr[1:] = np.cumsum(np.bincount(cells, minlength=rows * cols))
+
+    stat = os.stat(str(las_path))
+    index = LasIndex(cell_size, origin, (rows, cols), cell_ptr, starts.astype(np.int64), ends.astype(np.int64),
+                     stat.st_size, stat.st_mtime)
+    if save:
+        index.save(index_path(las_path))
+    return index
+
+def load_index(las_path):
+    """
+    Loads the index of a las file if one exists and is up to date.
+
+    :param las_path: The path of the las file.
+    :return: A LasIndex object, or None.
+    """
+    path = index_path(las_path)
+    if not os.path.exists(path):
+        return None
+    index = LasIndex.load(path)
+    if not index.is_valid_for(las_path):
+        return None
+    return index
@@ -0,0 +1,376 @@
+# Low level reading of uncompressed las files without decoding every point through laspy.
+
+import struct
+import numpy as np
+
+# (name, struct format, offset) of the public header block fields that pyfor uses
+_HEADER_FIELDS = [
+    ("file_signature", "4s", 0),
+    ("version_major", "B", 24),
+    ("version_minor", "B", 25),
+    ("header_size", "H", 94),
+    ("data_offset", "I", 96),
+    ("num_variable_len_recs", "I", 100),
+    ("data_format_id", "B", 104),
+    ("data_record_length", "H", 105),
+    ("legacy_point_records_count", "I", 107),
+    ("scale", "3d", 131),
+    ("offset", "3d", 155),
+    ("bounds", "6d", 179),
+]
+
+# The 1.4 header stores a 64 bit point count after the extended variable length record fields
+_EXTENDED_COUNT_OFFSET = 247
+
+# Point data record layouts for formats 0 through 3
+_BASE_FORMAT = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"), ("flag_byte", "u1"),
+                ("raw_classification", "u1"), ("scan_angle_rank", "i1"), ("user_data", "u1"), ("pt_src_id", "<u2")]
+_GPS_FORMAT = [("gps_time", "<f8")]
+_RGB_FORMAT = [("red", "<u2"), ("green", "<u2"), ("blue", "<u2")]
+
+POINT_FORMATS = {
+    0: _BASE_FORMAT,
+    1: _BASE_FORMAT + _GPS_FORMAT,
+    2: _BASE_FORMAT + _RGB_FORMAT,
+    3: _BASE_FORMAT + _GPS_FORMAT + _RGB_FORMAT,
+}
+
+# Dimensions packed into a single byte of the record, as (record field, bit shift, bit mask)
+_BIT_FIELDS = {
+    "return_num": ("flag_byte", 0, 0b111),
+    "num_returns": ("flag_byte", 3, 0b111),
+    "scan_dir_flag": ("flag_byte", 6, 0b1),
+    "edge_flight_line": ("flag_byte", 7, 0b1),
+    "classification": ("raw_classification", 0, 0b11111),
+    "synthetic": ("raw_classification", 5, 0b1),
+    "key_point": ("raw_classification", 6, 0b1),
+    "withheld": ("raw_classification", 7, 0b1),
+}
+
+_SCALED_FIELDS = {"x": ("X", 0), "y": ("Y", 1), "z": ("Z", 2)}
+
+# Every dimension of formats 0 through 3 by its laspy name. Whole bytes precede the bit fields packed into them so \
+# that writing in this order keeps any modified bit field.
+LAS_DIMS = ("x", "y", "z", "intensity", "flag_byte", "return_num", "num_returns", "scan_dir_flag", "edge_flight_line",
+            "raw_classification", "classification", "synthetic", "key_point", "withheld", "scan_angle_rank",
+            "user_data", "pt_src_id", "gps_time", "red", "green", "blue")
+
+class LasHeader:
+    """
+    A light weight, read only representation of the public header block of a las file. Attribute names mirror the \
+    laspy header where possible. Reading this does not touch the point records, and so is essentially free.
+
+    :param path: The path to the las or laz file.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, "rb") as las_file:
+            raw = las_file.read(_EXTENDED_COUNT_OFFSET + 8)
+
+        fields = {}
+        for name, fmt, offset in _HEADER_FIELDS:
+            values = struct.unpack_from("<" + fmt, raw, offset)
+            fields[name] = values[0] if len(values) == 1 else list(values)
+
+        if fields["file_signature"] != b"LASF":
+            raise ValueError("{} is not a las file.".format(self.path))
+
+        self.file_signature = fields["file_signature"].decode("ascii")
+        self.version_major = fields["version_major"]
+        self.version_minor = fields["version_minor"]
+        self.version = "{}.{}".format(fields["version_major"], fields["version_minor"])
+        self.header_size = fields["header_size"]
+        self.data_offset = fields["data_offset"]
+        self.num_variable_len_recs = fields["num_variable_len_recs"]
+        # Bits 6 and 7 of the format id flag a compressed (laz) file
+        self.compressed = bool(fields["data_format_id"] & 0b11000000)
+        self.data_format_id = fields["data_format_id"] & 0b00111111
+        self.data_record_length = fields["data_record_length"]
+        self.scale = fields["scale"]
+        self.offset = fields["offset"]
+
+        bounds = fields["bounds"]
+        self.max = [bounds[0], bounds[2], bounds[4]]
+        self.min = [bounds[1], bounds[3], bounds[5]]
+
+        count = fields["legacy_point_records_count"]
+        if count == 0 and self.header_size >= _EXTENDED_COUNT_OFFSET + 8:
+            count = struct.unpack_from("<Q", raw, _EXTENDED_COUNT_OFFSET)[0]
+        self.point_records_count = count
+
+    @property
+    def count(self):
+        return self.point_records_count
+
+    @property
+    def memmappable(self):
+        """True if the point records can be read directly from disk by pyfor, i.e. uncompressed formats 0 to 3."""
+        return not self.compressed and self.data_format_id in POINT_FORMATS
+
+    @property
+    def dtype(self):
+        """The numpy dtype of a single point data record."""
+        return point_dtype(self.data_format_id, self.data_record_length)
+
+def read_header(path):
+    """
+    Reads the public header block of a las file.
+
+    :param path: The path to the las file.
+    :return: A LasHeader object.
+    """
+    return LasHeader(path)
+
+def point_dtype(data_format_id, data_record_length):
+    """
+    Constructs the numpy dtype of a point data record. Any extra bytes at the end of the record are kept as an opaque \
+    void field so that records can be copied verbatim.
+
+    :param data_format_id: The point data format id (0 through 3).
+    :param data_record_length: The length of a single record in bytes, as given in the header.
+    :return: A numpy structured dtype.
+    """
+    if data_format_id not in POINT_FORMATS:
+        raise ValueError("Point data format {} is not supported.".format(data_format_id))
+
+    fields = list(POINT_FORMATS[data_format_id])
+    extra_bytes = data_record_length - np.dtype(fields).itemsize
+    if extra_bytes > 0:
+        fields.append(("extra_bytes", "V{}".format(extra_bytes)))
+    return np.dtype(fields)
+
+def memmap_points(path, header=None):
+    """
+    Memory maps the point data records of an uncompressed las file. Nothing is read from disk until the records are \
+    accessed.
+
+    :param path: The path to the las file.
+    :param header: An optional LasHeader of the file, read from path if not provided.
+    :return: A read only numpy memmap of point records.
+    """
+    if header is None:
+        header = read_header(path)
+    if not header.memmappable:
+        raise ValueError("{} is compressed or uses an unsupported point format.".format(path))
+    return np.memmap(str(path), dtype=header.dtype, mode="r", offset=header.data_offset,
+                     shape=(header.point_records_count,))
+
+def iter_records(path, chunk_size, header=None):
+    """
+    Reads the point data records of an uncompressed las file in chunks. Each chunk is read into its own array, so \
+    memory use depends on chunk_size and not on the size of the file.
+
+    :param path: The path to the las file.
+    :param chunk_size: The maximum number of records per chunk.
+    :param header: An optional LasHeader of the file, read from path if not provided.
+    :return: A generator of structured numpy arrays of point records.
+    """
+    if header is None:
+        header = read_header(path)
+    if not header.memmappable:
+        raise ValueError("{} is compressed or uses an unsupported point format.".format(path))
+
+    with open(str(path), "rb") as las_file:
+        las_file.seek(header.data_offset)
+        remaining = header.point_records_count
+        while remaining > 0:
+            count = min(chunk_size, remaining)
+            yield np.fromfile(las_file, dtype=header.dtype, count=count)
+            remaining -= count
+
+def raw_bounds(header, bounds):
+    """
+    Converts a bounding box to the scaled integer coordinates of the point records, such that a point is inside the \
+    (inclusive) bounding box if and only if its raw X and Y are inside the returned (inclusive) bounds.
+
+    :param header: A LasHeader.
+    :param bounds: A tuple of (min x, min y, max x, max y).
+    :return: A tuple of (min X, min Y, max X, max Y) integers.
+    """
+    min_x = np.ceil((bounds[0] - header.offset[0]) / header.scale[0])
+    min_y = np.ceil((bounds[1] - header.offset[1]) / header.scale[1])
+    max_x = np.floor((bounds[2] - header.offset[0]) / header.scale[0])
+    max_y = np.floor((bounds[3] - header.offset[1]) / header.scale[1])
+    return int(min_x), int(min_y), int(max_x), int(max_y)
+
+def in_bounds(records, raw_box):
+    """
+    Returns a boolean mask of the point records inside a bounding box of raw coordinates, see raw_bounds.
+    """
+    X, Y = records["X"], records["Y"]
+    return (X >= raw_box[0]) & (X <= raw_box[2]) & (Y >= raw_box[1]) & (Y <= raw_box[3])
+
+def read_clipped(path, bounds, header=None, chunk_size=5000000):
+    """
+    Reads only the point records inside a bounding box. The bounding box test is applied to each chunk as it is read \
+    so that points outside of it are never kept in memory.
+
+    :param path: The path to the las file.
+    :param bounds: A tuple of (min x, min y, max x, max y).
+    :param header: An optional LasHeader of the file, read from path if not provided.
+    :param chunk_size: The number of records to read at a time.
+    :return: A structured numpy array of point records.
+    """
+    if header is None:
+        header = read_header(path)
+
+    # Skip the file entirely if the header bounds do not intersect
+    if bounds[0] > header.max[0] or bounds[2] < header.min[0] or bounds[1] > header.max[1] or \
+            bounds[3] < header.min[1]:
+        return np.zeros(0, dtype=header.dtype)
+
+    raw_box = raw_bounds(header, bounds)
+    kept = [records[in_bounds(records, raw_box)] for records in iter_records(path, chunk_size, header)]
+    if len(kept) == 0:
+        return np.zeros(0, dtype=header.dtype)
+    return np.concatenate(kept)
+
+def decode(records, dim, header):
+    """
+    Decodes a single dimension from an array of point records into a new array.
+
+    :param records: A structured array (or memmap) of point records.
+    :param dim: The dimension name as used by laspy, i.e. "x", "intensity" or "return_num".
+    :param header: The LasHeader of the file the records come from.
+    :return: A 1D numpy array, x, y and z are scaled to float64, all others are kept in their native dtype.
+    """
+    if dim in _SCALED_FIELDS:
+        field, axis = _SCALED_FIELDS[dim]
+        return records[field] * header.scale[axis] + header.offset[axis]
+    if dim in _BIT_FIELDS:
+        field, shift, mask = _BIT_FIELDS[dim]
+        return (records[field] >> shift) & mask
+    if dim in records.dtype.names:
+        return np.array(records[dim])
+    raise KeyError("Dimension {} is not present in point format {}.".format(dim, header.data_format_id))
+
+def has_dimension(header, dim):
+    """
+    Checks if a dimension can be decoded from the point format described by header.
+    """
+    return dim in _SCALED_FIELDS or dim in _BIT_FIELDS or dim in header.dtype.names
+
+def encode(points, header, dtype):
+    """
+    Encodes the dimensions of points into an array of point records, the inverse of decode. Dimensions missing from \
+    points are set to zero.
+
+    :param points: A PointStore (or any mapping of dimension names to arrays) of the points to encode.
+    :param header: The LasHeader whose scale and offset are applied to x, y and z.
+    :param dtype: The numpy dtype of the point records, see point_dtype.
+    :return: A structured numpy array of point records.
+    """
+    records = np.zeros(len(points), dtype=dtype)
+    for dim in LAS_DIMS:
+        if dim not in points or not has_dimension(header, dim):
+            continue
+        if dim in _SCALED_FIELDS:
+            field, axis = _SCALED_FIELDS[dim]
+            raw = points.raw_coordinate(dim) if hasattr(points, "raw_coordinate") else None
+            if raw is not None and raw[1] == header.scale[axis] and raw[2] == header.offset[axis]:
+                records[field] = raw[0]
+            else:
+                records[field] = np.round((np.asarray(points[dim]) - header.offset[axis]) / header.scale[axis])
+            continue
+
+        values = np.asarray(points[dim])
+        if dim in _BIT_FIELDS:
+            field, shift, mask = _BIT_FIELDS[dim]
+            cleared = records[field] & ~np.uint8(mask << shift)
+            records[field] = cleared | ((values.astype(np.uint8) & mask) << shift)
+        else:
+            records[dim] = values
+    return records
+
+class LasWriter:
+    """
+    Writes point records to an uncompressed las file incrementally, so that files larger than memory can be written \
+    one chunk at a time. The header and variable length records are copied from a template file, the point count, \
+    the points by return and the bounding box are updated when the writer is closed. This is the streaming \
+    counterpart of CloudData.write, and is typically used with Cloud.iter_chunks:
+
+    >>> with LasWriter("out.las", "in.las") as writer:
+    ...     for chunk in Cloud.iter_chunks("in.las"):
+    ...         writer.write(chunk)
+
+    :param path: The path of the output las file.
+    :param template: The path of a las file whose header is copied, its point format must be 0 through 3.
+    """
+    def __init__(self, path, template):
+        self.path = str(path)
+        self.header = read_header(template)
+        if self.header.data_format_id not in POINT_FORMATS:
+            raise ValueError("Point data format {} is not supported.".format(self.header.data_format_id))
+
+        self.dtype = self.header.dtype
+        self.count = 0
+        self.points_by_return = np.zeros(5, dtype=np.uint64)
+        self._raw_min = None
+        self._raw_max = None
+
+        with open(self.header.path, "rb") as template_file:
+            header_bytes = bytearray(template_file.read(self.header.data_offset))
+        # Records are always written uncompressed
+        header_bytes[104] = self.header.data_format_id
+
+        self._file = open(self.path, "wb")
+        self._file.write(header_bytes)
+
+    def write(self, points):
+        """
+        Appends points to the file.
+
+        :param points: A CloudData, PointStore or structured array of point records with the dtype of this writer.
+        """
+        if hasattr(points, "points"):
+            points = points.points
+        if isinstance(points, np.ndarray) and points.dtype == self.dtype:
+            records = points
+        else:
+            records = encode(points, self.header, self.dtype)
+
+        if len(records) == 0:
+            return
+
+        xyz = np.stack([records["X"], records["Y"], records["Z"]])
+        chunk_min, chunk_max = xyz.min(axis=1), xyz.max(axis=1)
+        if self._raw_min is None:
+            self._raw_min, self._raw_max = chunk_min, chunk_max
+        else:
+            self._raw_min = np.minimum(self._raw_min, chunk_min)
+            self._raw_max = np.maximum(self._raw_max, chunk_max)
+
+        return_num = records["flag_byte"] & 0b111
+        self.points_by_return += np.bincount(return_num, minlength=6)[1:6].astype(np.uint64)
+        self.count += len(records)
+        self._file.write(np.ascontiguousarray(records).tobytes())
+
+    def close(self):
+        """
+        Updates the header of the written file and closes it.
+        """
+        if self._file.closed:
+            return
+
+        struct_min, struct_max = [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+        if self._raw_min is not None:
+            struct_min = [self._raw_min[i] * self.header.scale[i] + self.header.offset[i] for i in range(3)]
+            struct_max = [self._raw_max[i] * self.header.scale[i] + self.header.offset[i] for i in range(3)]
+
+        self._file.seek(107)
+        self._file.write(struct.pack("<I", min(self.count, 2**32 - 1)))
+        self._file.write(struct.pack("<5I", *[min(int(n), 2**32 - 1) for n in self.points_by_return]))
+        self._file.seek(179)
+        self._file.write(struct.pack("<6d", struct_max[0], struct_min[0], struct_max[1], struct_min[1],
+                                     struct_max[2], struct_min[2]))
+        if self.header.header_size >= _EXTENDED_COUNT_OFFSET + 8 * 16:
+            self._file.seek(_EXTENDED_COUNT_OFFSET)
+            self._file.write(struct.pack("<Q", self.count))
+            self._file.write(struct.pack("<15Q", *(list(self.points_by_return.astype(int)) + [0] * 10)))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,97 @@
+# Area based metrics of groups of points (i.e. grid cells or plots), computed in a single sorted pass.
+
+import numpy as np
+from collections import OrderedDict
+
+# The height percentiles computed by default
+DEFAULT_PERCENTILES = (10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99)
+
+def metric_names(percentiles=DEFAULT_PERCENTILES):
+    """
+    Returns the names of the metrics computed by group_metrics, in order.
+
+    :param percentiles: The percentiles that are computed.
+    """
+    names = ["count", "mean", "std", "skewness", "kurtosis", "min", "max"]
+    names += ["p{}".format(p) for p in percentiles]
+    names.append("cover")
+    return names
+
+def group_metrics(group_id, values, percentiles=DEFAULT_PERCENTILES, cover_threshold=2, cover_mask=None):
+    """
+    Computes the standard set of area based metrics of each group of points. The points are sorted by group and \
+    value once, after which every metric is computed with vectorized operations over the sorted values, instead of \
+    calling one function per metric per group.
+
+    std, skewness and kurtosis are the bias corrected sample statistics, as computed by pandas. Percentiles are \
+    linearly interpolated, as computed by np.percentile.
+
+    :param group_id: A 1D array of the non-negative integer group of each point.
+    :param values: A 1D array of the value of each point, i.e. z.
+    :param percentiles: The percentiles to compute.
+    :param cover_threshold: cover is the proportion of points above this value.
+    :param cover_mask: An optional boolean mask of the points used for cover, i.e. first returns. By default all \
+    points are used.
+    :return: A tuple of the sorted 1D array of the groups with at least one point, and an OrderedDict of metric names \
+    (see metric_names) and 1D arrays of the metric of each of those groups.
+    """
+    group_id = np.asarray(group_id)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.lexsort((values, group_id))
+    group_id, values = group_id[order], values[order]
+
+    starts = np.flatnonzero(np.r_[True, group_id[1:] != group_id[:-1]]) if len(group_id) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.r_[starts, len(group_id)])
+    groups = group_id[starts]
+
+    metrics = OrderedDict()
+    metrics["count"] = counts
+    if len(groups) == 0:
+        for name in metric_names(percentiles)[1:]:
+            metrics[name] = np.zeros(0)
+        return groups, metrics
+
+    n = counts.astype(np.float64)
+    mean = np.add.reduceat(values, starts) / n
+    deviation = values - np.repeat(mean, counts)
+    m2 = np.add.reduceat(deviation**2, starts) / n
+    m3 = np.add.reduceat(deviation**3, starts) / n
+    m4 = np.add.reduceat(deviation**4, starts) / n
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(m2 * n / (n - 1))
+        skewness = np.sqrt(n * (n - 1)) / (n - 2) * m3 / m2**1.5
+        kurtosis = ((n + 1) * (m4 / m2**2 - 3) + 6) * (n - 1) / ((n - 2) * (n - 3))
+    std[n < 2] = np.nan
+    skewness = np.where(m2 == 0, 0, skewness)
+    skewness[n < 3] = np.nan
+    kurtosis = np.where(m2 == 0, 0, kurtosis)
+    kurtosis[n < 4] = np.nan
+
+    metrics["mean"] = mean
+    metrics["std"] = std
+    metrics["skewness"] = skewness
+    metrics["kurtosis"] = kurtosis
+    metrics["min"] = values[starts]
+    metrics["max"] = values[starts + counts - 1]
+
+    # Values are sorted within each group, so percentiles are interpolated between two order statistics
+    for p in percentiles:
+        position = (counts - 1) * (p / 100)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, counts - 1)
+        low, high = values[starts + below], values[starts + above]
+        metrics["p{}".format(p)] = low + (high - low) * (position - below)
+
+    if cover_mask is None:
+        above = (values > cover_threshold).astype(np.float64)
+        total = n
+    else:
+        cover_mask = np.asarray(cover_mask)[order]
+        above = ((values > cover_threshold) & cover_mask).astype(np.float64)
+        total = np.add.reduceat(cover_mask.astype(np.float64), starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["cover"] = np.add.reduceat(above, starts) / total
+
+    return groups, metrics
@@ -0,0 +1,376 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from functools import partial
+
+def _as_array(values):
+    """
+    Converts values to a numpy array, memory mapped arrays are kept as they are so that they are not copied.
+    """
+    if isinstance(values, np.memmap):
+        return values
+    return np.asarray(values)
+
+class LazyColumn:
+    """
+    A placeholder for a dimension that has not yet been read or selected, see PointStore.add_lazy and \
+    PointStore.select.
+
+    :param loader: A callable without arguments that returns the 1D array of the dimension.
+    :param index: An optional 1D array of integer positions, if given only these positions of the loaded array are kept.
+    """
+    def __init__(self, loader, index=None):
+        self.loader = loader
+        self.index = index
+
+    def load(self):
+        values = _as_array(self.loader())
+        if self.index is not None:
+            values = values[self.index]
+        return values
+
+    def take(self, positions):
+        """
+        Returns a new LazyColumn that only loads the selected points. Successive selections are composed into a \
+        single index so that the dimension is gathered only once when it is loaded.
+
+        :param positions: A 1D array of integer positions into this column.
+        """
+        index = positions if self.index is None else self.index[positions]
+        return LazyColumn(self.loader, index)
+
+def _constant(values):
+    return values
+
+class ScaledColumn:
+    """
+    A float dimension that is stored as scaled integers in another dimension of the same PointStore, i.e. las \
+    coordinates, see PointStore.add_scaled.
+
+    :param raw: The name of the integer dimension.
+    :param scale: The scale factor.
+    :param offset: The offset.
+    """
+    def __init__(self, raw, scale, offset):
+        self.raw = raw
+        self.scale = scale
+        self.offset = offset
+
+    def to_float(self, raw_values):
+        return raw_values * self.scale + self.offset
+
+    def to_raw(self, values, dtype):
+        return np.round((np.asarray(values) - self.offset) / self.scale).astype(dtype)
+
+class PointStore:
+    """
+    A columnar container of point dimensions, meant for internal use as the backend of CloudData.points. Each \
+    dimension is held as its own numpy array in its native LAS dtype (i.e. uint16 for intensity, uint8 for \
+    classification) rather than being upcast into a single pandas DataFrame.
+
+    The most common DataFrame idioms used throughout pyfor are supported, i.e. `points["z"]`, `points.z`, \
+    `points[["x", "y"]].values`, `points[mask]` and `points["new_dim"] = array`. Use PointStore.to_pandas for legacy \
+    code that requires a full DataFrame.
+
+    Dimensions can also be registered lazily with PointStore.add_lazy, in which case they are only decoded the first \
+    time they are accessed, or as scaled integers with PointStore.add_scaled, in which case their float values are \
+    computed on each access and never stored.
+
+    :param columns: A dictionary-like object of dimension names and 1D arrays of equal length.
+    :param length: The number of points, only required if the store is created without any loaded dimensions.
+    """
+    def __init__(self, columns=None, length=None):
+        self._columns = OrderedDict()
+        self._versions = {}
+        # Names of loaded dimensions whose arrays are also read by selections, see PointStore.is_shared
+        self._shared = set()
+        self._length = length
+        if columns is not None:
+            for name, values in columns.items():
+                self[name] = values
+
+    @classmethod
+    def lazy(cls, loaders, length):
+        """
+        Constructs a PointStore where every dimension is loaded on first access.
+
+        :param loaders: A dictionary-like object of dimension names and callables that return the dimension array.
+        :param length: The number of points.
+        :return: A PointStore object.
+        """
+        store = cls(length=length)
+        for name, loader in loaders.items():
+            store.add_lazy(name, loader)
+        return store
+
+    def add_lazy(self, name, loader):
+        """
+        Registers a dimension that is only loaded the first time it is accessed.
+
+        :param name: The dimension name.
+        :param loader: A callable without arguments that returns the 1D array of the dimension.
+        """
+        self._columns[name] = LazyColumn(loader)
+
+    def add_scaled(self, name, raw, scale, offset):
+        """
+        Registers a float dimension that is stored as scaled integers in the dimension raw, such that \
+        points[name] == points[raw] * scale + offset. The float values are computed on each access and are not \
+        stored. Assigning to the dimension quantizes the new values back into raw.
+
+        :param name: The name of the float dimension, i.e. "x".
+        :param raw: The name of an existing integer dimension, i.e. "X".
+        :param scale: The scale factor.
+        :param offset: The offset.
+        """
+        self._columns[name] = ScaledColumn(raw, scale, offset)
+
+    def raw_coordinate(self, name):
+        """
+        Returns the integer storage of a scaled dimension.
+
+        :param name: The dimension name.
+        :return: A tuple of (raw integer array, scale, offset) if the dimension is stored as scaled integers, \
+        otherwise None.
+        """
+        column = self._columns.get(name)
+        if not isinstance(column, ScaledColumn):
+            return None
+        return self._get(column.raw), column.scale, column.offset
+
+    def is_loaded(self, name):
+        """
+        Checks if a dimension has been loaded into memory.
+        """
+        column = self._columns[name]
+        if isinstance(column, ScaledColumn):
+            return self.is_loaded(column.raw)
+        return not isinstance(column, LazyColumn)
+
+    def is_shared(self, name):
+        """
+        Checks if the array of a loaded dimension may also be read by a selection of this store, see \
+        PointStore.select. Such arrays must not be modified in place, assign a new array instead.
+        """
+        column = self._columns[name]
+        if isinstance(column, ScaledColumn):
+            return self.is_shared(column.raw)
+        return name in self._shared
+
+    def _get(self, name):
+        values = self._columns[name]
+        if isinstance(values, LazyColumn):
+            values = values.load()
+            self._columns[name] = values
+        elif isinstance(values, ScaledColumn):
+            values = values.to_float(self._get(values.raw))
+        return values
+
+    def _items(self):
+        return ((name, self._get(name)) for name in self.columns)
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        """
+        Constructs a PointStore from a pandas DataFrame, each column becomes a dimension.
+
+        :param dataframe: A pandas DataFrame of points.
+        :return: A PointStore object.
+        """
+        return cls(OrderedDict((column, dataframe[column].values) for column in dataframe.columns))
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("_columns")
+        if columns is not None and name in columns:
+            return self._get(name)
+        raise AttributeError("'PointStore' object has no attribute '{}'".format(name))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._get(key)
+        if isinstance(key, (list, tuple)):
+            return PointStore(OrderedDict((name, self._get(name)) for name in key))
+        return self.take(key)
+
+    def __setitem__(self, name, values):
+        if np.isscalar(values):
+            values = np.full(len(self), values)
+        elif isinstance(values, pd.Series):
+            values = values.values
+        else:
+            values = _as_array(values)
+
+        if values.ndim != 1:
+            raise ValueError("Dimensions must be one dimensional arrays.")
+        if self._length is not None and len(self._columns) > 0 and len(values) != self._length:
+            raise ValueError("Length of values ({}) does not match the number of points ({})."
+                             .format(len(values), len(self)))
+
+        self._versions[name] = self._versions.get(name, 0) + 1
+        self._shared.discard(name)
+        column = self._columns.get(name)
+        if isinstance(column, ScaledColumn):
+            raw_values = self._get(column.raw)
+            self._columns[column.raw] = column.to_raw(values, raw_values.dtype)
+            self._shared.discard(column.raw)
+            return
+        self._columns[name] = values
+        self._length = len(values)
+
+    def __delitem__(self, name):
+        del self._columns[name]
+        self._versions[name] = self._versions.get(name, 0) + 1
+        self._shared.discard(name)
+
+    def version(self, name):
+        """
+        Returns a counter that increases every time the dimension is assigned or deleted. This is used to detect \
+        results that were computed from values that have since changed, i.e. the memoized rasters of a Grid. Note \
+        that modifying an array in place, i.e. points["z"][:] = 0, is not detected.
+
+        :param name: The dimension name.
+        """
+        version = self._versions.get(name, 0)
+        column = self._columns.get(name)
+        if isinstance(column, ScaledColumn):
+            version += self._versions.get(column.raw, 0)
+        return version
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        if self._length is None:
+            return 0
+        return self._length
+
+    @property
+    def columns(self):
+        """A list of the dimension names."""
+        return list(self._columns.keys())
+
+    @property
+    def dtypes(self):
+        """A dictionary of dimension names and their numpy dtypes."""
+        return OrderedDict((name, values.dtype) for name, values in self._items())
+
+    @property
+    def values(self):
+        """An N x D numpy array of all dimensions, upcast to a common dtype."""
+        return np.column_stack([values for name, values in self._items()])
+
+    @property
+    def nbytes(self):
+        """The total number of bytes consumed by the loaded dimension arrays."""
+        return sum(values.nbytes for values in self._columns.values()
+                   if not isinstance(values, (LazyColumn, ScaledColumn)))
+
+    def take(self, indices):
+        """
+        Returns a new PointStore with only the selected points. Dimensions that have not been loaded yet stay lazy.
+
+        :param indices: A boolean mask, an array of integer indices or a slice.
+        :return: A PointStore object.
+        """
+        indices = self._normalize_indices(indices)
+        positions = None
+
+        taken = PointStore(length=self._selection_length(indices))
+        for name, values in self._columns.items():
+            if isinstance(values, LazyColumn):
+                if positions is None:
+                    positions = self._positions(indices)
+                taken._columns[name] = values.take(positions)
+            elif isinstance(values, ScaledColumn):
+                taken._columns[name] = values
+            else:
+                taken._columns[name] = values[indices]
+                if isinstance(indices, slice):
+                    # A slice is a view of this array
+                    self._shared.add(name)
+        return taken
+
+    def select(self, indices):
+        """
+        Returns a new PointStore of the selected points without copying any dimension. Each dimension is gathered the \
+        first time it is accessed, and successive selections are composed, so a chain of filters costs a single \
+        gather per dimension that is actually read. Until then the selection reads the arrays of this store, which \
+        are marked as shared, see PointStore.is_shared.
+
+        :param indices: A boolean mask, an array of integer indices or a slice.
+        :return: A PointStore object.
+        """
+        positions = self._positions(self._normalize_indices(indices))
+
+        selected = PointStore(length=len(positions))
+        for name, values in self._columns.items():
+            if isinstance(values, LazyColumn):
+                selected._columns[name] = values.take(positions)
+            elif isinstance(values, ScaledColumn):
+                selected._columns[name] = values
+            else:
+                selected._columns[name] = LazyColumn(partial(_constant, values), positions)
+                self._shared.add(name)
+        return selected
+
+    @staticmethod
+    def _normalize_indices(indices):
+        if isinstance(indices, pd.Series):
+            indices = indices.values
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        return indices
+
+    def _selection_length(self, indices):
+        if isinstance(indices, slice):
+            return len(range(len(self))[indices])
+        if indices.dtype == bool:
+            return int(np.count_nonzero(indices))
+        return len(indices)
+
+    def _positions(self, indices):
+        """
+        Converts a boolean mask, integer indices or a slice to an array of integer positions.
+        """
+        if isinstance(indices, slice):
+            return np.arange(len(self))[indices]
+        if indices.dtype == bool:
+            return np.flatnonzero(indices)
+        return indices
+
+    def copy(self):
+        """Returns a deep copy of the PointStore."""
+        copied = PointStore(length=len(self))
+        for name, values in self._columns.items():
+            if isinstance(values, ScaledColumn):
+                copied._columns[name] = values
+            else:
+                copied._columns[name] = self._get(name).copy()
+        return copied
+
+    def to_pandas(self):
+        """
+        Returns the points as a pandas DataFrame. This is provided for legacy callers and copies every dimension, \
+        avoid it for large clouds.
+
+        :return: A pandas DataFrame.
+        """
+        return pd.DataFrame(OrderedDict(self._items()), columns=self.columns)
+
+    def __repr__(self):
+        return "PointStore({} points, dimensions: {})".format(len(self), ", ".join(self.columns))
+
+def concat(stores):
+    """
+    Concatenates the points of several PointStores. Only the dimensions present in every store are kept. Dimensions \
+    stored as scaled integers are concatenated as floats, as the stores may use different scales and offsets.
+
+    :param stores: A list of PointStore objects.
+    :return: A PointStore object.
+    """
+    raw = set(column.raw for store in stores for column in store._columns.values() if isinstance(column, ScaledColumn))
+    columns = [name for name in stores[0].columns if name not in raw and all(name in store for store in stores)]
+    return PointStore(OrderedDict((name, np.concatenate([store[name] for store in stores])) for name in columns))
@@ -1,17 +1,154 @@
 # Functions for rasterizing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
-from scipy.interpolate import griddata
+from numba import njit
 import matplotlib.pyplot as plt
 from pyfor import gisexport
 from pyfor import filter
 from pyfor import plot
+from pyfor.metrics import DEFAULT_PERCENTILES, group_metrics
+from pyfor.interpolation import fill_nan, sample
+from pyfor.terrain import TerrainModel
+
+def _cell_coordinate(points, dim, origin, cell_size, count):
+    """
+    Computes the cell of each point along one axis as floor((x - origin) / cell_size), clipped to [0, count). Scaled \
+    integer coordinates are binned without converting them to floats first.
+
+    :param points: A PointStore object.
+    :param dim: The coordinate dimension, "x" or "y".
+    :param origin: The minimum coordinate of the grid along the axis.
+    :param cell_size: The size of the cells.
+    :param count: The number of cells along the axis.
+    :return: A 1D int64 array of cell coordinates.
+    """
+    raw = points.raw_coordinate(dim)
+    if raw is None:
+        cells = np.floor((points[dim] - origin) / cell_size)
+    else:
+        raw_values, scale, offset = raw
+        raw_origin = (origin - offset) / scale
+        cells = np.floor((raw_values - raw_origin) * (scale / cell_size))
+    return np.clip(cells, 0, count - 1).astype(np.int64)
+
+def _reduce_std(values, starts, counts):
+    sums = np.add.reduceat(values, starts)
+    means = np.repeat(sums / counts, counts)
+    squares = np.add.reduceat((values - means)**2, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # The sample standard deviation, as in pandas, is undefined for cells with a single point
+        return np.sqrt(squares / (counts - 1))
+
+# Reducers that are computed directly on points sorted by cell. Each takes the sorted values, the position of the \
+# first point of each occupied cell and the number of points in each occupied cell.
+_REDUCERS = {
+    "max": lambda values, starts, counts: np.maximum.reduceat(values, starts),
+    "min": lambda values, starts, counts: np.minimum.reduceat(values, starts),
+    "sum": lambda values, starts, counts: np.add.reduceat(values.astype(np.float64), starts),
+    "count": lambda values, starts, counts: counts,
+    "mean": lambda values, starts, counts: np.add.reduceat(values.astype(np.float64), starts) / counts,
+    "std": lambda values, starts, counts: _reduce_std(values.astype(np.float64), starts, counts)
+}
+
+# numpy functions are treated as their string equivalents, as pandas does
+_REDUCER_NAMES = {np.max: "max", np.amax: "max", np.min: "min", np.amin: "min", np.sum: "sum", np.mean: "mean",
+                  np.std: "std", len: "count", max: "max", min: "min", sum: "sum"}
+
+def _reducer(func):
+    """
+    Returns the fast reducer for func, or None if func must be computed with pandas.
+    """
+    if not isinstance(func, str):
+        try:
+            func = _REDUCER_NAMES.get(func)
+        except TypeError:
+            return None
+    return _REDUCERS.get(func)
+
+def _return_mask(points, returns):
+    """
+    Computes a boolean mask of the first returns or the last returns of a PointStore.
+
+    :param points: A PointStore object.
+    :param returns: One of "first" or "last".
+    """
+    if "return_num" in points:
+        return_num = points["return_num"]
+    else:
+        return_num = points["flag_byte"] & 0b111
+    if returns == "first":
+        return return_num == 1
+    if returns == "last":
+        if "num_returns" in points:
+            num_returns = points["num_returns"]
+        else:
+            num_returns = (points["flag_byte"] >> 3) & 0b111
+        return return_num == num_returns
+    raise ValueError("returns must be one of None, 'first' or 'last'.")
+
+@njit
+def _window_maxima(array, rows, cols, radius):
+    """
+    Tests whether each cell (rows[i], cols[i]) is the maximum of the circle of radius[i] cells around it.
+    """
+    m, n = array.shape
+    maxima = np.ones(len(rows), dtype=np.bool_)
+    for p in range(len(rows)):
+        i, j, r = rows[p], cols[p], radius[p]
+        height = array[i, j]
+        for k in range(max(i - r, 0), min(i + r + 1, m)):
+            for l in range(max(j - r, 0), min(j + r + 1, n)):
+                if (k - i)**2 + (l - j)**2 <= r**2 and array[k, l] > height:
+                    maxima[p] = False
+                    break
+            if not maxima[p]:
+                break
+    return maxima
+
+class CellIndex:
+    """
+    A compressed sparse row (CSR) index of the points in each cell of a Grid. The points are sorted once by their \
+    cell, so the points of cell i are order[cell_ptr[i]:cell_ptr[i+1]], in their original relative order.
+
+    :param cell_id: A 1D array of the linear cell id of each point.
+    :param n_cells: The number of cells in the grid.
+    """
+    def __init__(self, cell_id, n_cells):
+        self.order = np.argsort(cell_id, kind="mergesort")
+        self.cell_ptr = np.zeros(n_cells + 1, dtype=np.int64)
+        self.cell_ptr[1:] = np.cumsum(np.bincount(cell_id, minlength=n_cells))
+        self.sorted_id = cell_id[self.order]
+
+    @property
+    def counts(self):
+        """The number of points in each cell."""
+        return np.diff(self.cell_ptr)
+
+    @property
+    def occupied(self):
+        """The sorted linear ids of the cells that contain at least one point."""
+        return np.flatnonzero(self.counts)
+
+    def groupby(self, values):
+        """
+        Groups values by cell without sorting them again.
+
+        :param values: A 1D array with one value per point, in the original point order.
+        :return: A pandas SeriesGroupBy object, keyed by the linear cell id.
+        """
+        return pd.Series(np.asarray(values)[self.order]).groupby(self.sorted_id, sort=False)
 
 class Grid:
     """The Grid object is a representation of a point cloud that has been sorted into X and Y dimensional bins. It is \
     not quite a raster yet. A raster has only one value per cell, whereas the Grid object merely sorts all points \
     into their respective cells.
 
+    The cell of each point is kept as a linear id, bins_y * n + bins_x, in Grid.cell_id. The parent cloud is not \
+    modified.
+
     :param cloud: The "parent" cloud object.
     :param cell_size: The size of the cell for sorting in the units of the input cloud object.
     :return: Returns a dataframe with sorted x and y with associated bins in a new columns
@@ -25,48 +162,183 @@ class Grid:
         min_x, max_x = self.las.min[0], self.las.max[0]
         min_y, max_y = self.las.min[1], self.las.max[1]
 
-        self.m = int(np.floor((max_y - min_y) / cell_size))
-        self.n = int(np.floor((max_x - min_x) / cell_size))
+        # The cells start at the minimum x and y, the last row and column may extend past the maximum
+        self.m = max(int(np.ceil((max_y - min_y) / cell_size)), 1)
+        self.n = max(int(np.ceil((max_x - min_x) / cell_size)), 1)
 
-        # Create bins
-        bins_x = np.searchsorted(np.linspace(min_x, max_x, self.n), self.las.points["x"])
-        bins_y = np.searchsorted(np.linspace(min_y, max_y, self.m), self.las.points["y"])
+        # Points on the far edges fall in the last row and column
+        bins_x = _cell_coordinate(self.las.points, "x", min_x, cell_size, self.n)
+        bins_y = _cell_coordinate(self.las.points, "y", min_y, cell_size, self.m)
+        self.cell_id = bins_y * self.n + bins_x
 
-        self.data = self.las.points
-        self.data["bins_x"] = bins_x
-        self.data["bins_y"] = bins_y
+        self._cell_index = None
+        self._data = None
+        self._cells = None
 
-        self.cells = self.data.groupby(['bins_x', 'bins_y'])
+        # Memoized products, see Grid._memoized
+        self._points = self.las.points
+        self._binned_version = self._version(("x", "y"))
+        self._products = {}
 
-    def raster(self, func, dim):
+    def _version(self, dims):
+        return tuple(self.las.points.version(dim) for dim in dims)
+
+    @property
+    def _max_y(self):
+        """The y coordinate of the top edge of the last row, the origin of rasters written from this grid."""
+        return self.las.min[1] + self.m * self.cell_size
+
+    @property
+    def is_current(self):
+        """
+        True if the parent cloud still holds the points this grid was built from and their x and y have not been \
+        assigned since, see Cloud.grid.
+        """
+        return self.cloud.las is self.las and self.las.points is self._points and \
+               self._version(("x", "y")) == self._binned_version
+
+    def _memoized(self, key, dims, compute):
+        """
+        Returns the array computed by compute, reusing the result of an earlier call with the same key if none of \
+        dims have been assigned since. A copy is returned as rasters may be modified in place, i.e. by \
+        Raster.pit_filter.
+
+        :param key: A hashable key of the product, i.e. ("raster", "max", "z").
+        :param dims: The dimensions the product is computed from.
+        :param compute: A callable without arguments that returns the array, or None.
+        """
+        if self._data is not None or not self.is_current:
+            # Grid.data may have been modified directly, i.e. by Grid.normalize
+            return compute()
+
+        version = self._version(dims)
+        if key in self._products and self._products[key][0] == version:
+            array = self._products[key][1]
+        else:
+            array = compute()
+            self._products[key] = (version, array)
+        return None if array is None else array.copy()
+
+    @property
+    def cell_index(self):
+        """The CellIndex of the grid, built the first time it is needed and reused afterwards."""
+        if self._cell_index is None:
+            self._cell_index = CellIndex(self.cell_id, self.m * self.n)
+        return self._cell_index
+
+    @property
+    def bins_x(self):
+        """The column of each point."""
+        return self.cell_id % self.n
+
+    @property
+    def bins_y(self):
+        """The row of each point."""
+        return self.cell_id // self.n
+
+    @property
+    def data(self):
+        """
+        A pandas DataFrame copy of the points with their bins_x and bins_y, built on first access. Prefer \
+        Grid.cell_id and Grid.cell_index, which do not copy the points.
+        """
+        if self._data is None:
+            self._data = self.las.points.to_pandas()
+            self._data["bins_x"] = self.bins_x
+            self._data["bins_y"] = self.bins_y
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._cells = None
+        self._products = {}
+
+    @property
+    def cells(self):
+        """A pandas groupby of Grid.data by bins_x and bins_y, built on first access."""
+        if self._cells is None:
+            self._cells = self.data.groupby(['bins_x', 'bins_y'])
+        return self._cells
+
+    @cells.setter
+    def cells(self, value):
+        self._cells = value
+
+    def _values(self, dim):
+        if self._data is not None:
+            return self._data[dim].values
+        return self.las.points[dim]
+
+    def _cell_array(self, cell_values):
+        """
+        Scatters a Series of values indexed by linear cell id into an m x n array, cells without a value are nan.
+        """
+        array = np.full(self.m * self.n, np.nan)
+        array[np.asarray(cell_values.index, dtype=np.int64)] = cell_values.values
+        return array.reshape(self.m, self.n)
+
+    def raster(self, func, dim, returns=None):
         """
         Generates an m x n matrix with values as calculated for each cell in func. This is a raw array without \
         missing cells interpolated. See self.interpolate for interpolation methods.
 
+        The reducers "max", "min", "mean", "sum", "count" and "std" (or their numpy equivalents) are computed in a \
+        single vectorized pass over the points sorted by cell. Any other function is computed with pandas.
+
         :param func: A function string, i.e. "max" or a function itself, i.e. np.max. This function must be able to \
         take a 1D array of the given dimension as an input and produce a single value as an output. This single value \
         will become the value of each cell in the array.
         :param dim: The dimension to calculate on as a string, see the column names of self.data for a full list of \
         options
+        :param returns: If "first" or "last", only the first or last returns of each pulse are used.
         :return: A 2D numpy array where the value of each cell is the result of the passed function.
         """
-
-        array = self.cells.agg({dim: func}).reset_index().pivot('bins_y', 'bins_x', dim)
-        array = np.asarray(array)
-        return Raster(array, self)
+        reducer = _reducer(func)
+        if reducer is None:
+            return Raster(self._raster_array(func, dim, returns), self)
+
+        # Rasters of the fast reducers are memoized
+        key = ("raster", _REDUCER_NAMES.get(func, func), dim, returns)
+        dims = (dim, "return_num", "num_returns", "flag_byte") if returns is not None else (dim,)
+        return Raster(self._memoized(key, dims, lambda: self._raster_array(func, dim, returns)), self)
+
+    def _raster_array(self, func, dim, returns):
+        index = self.cell_index
+        cell_id = index.sorted_id
+        values = np.asarray(self._values(dim))[index.order]
+        if returns is not None:
+            keep = _return_mask(self.las.points, returns)[index.order]
+            cell_id, values = cell_id[keep], values[keep]
+
+        reducer = _reducer(func)
+        if reducer is None or len(values) == 0 or (values.dtype.kind == "f" and np.isnan(values).any()):
+            # pandas skips nan values
+            cell_values = pd.Series(values).groupby(cell_id, sort=False).agg(func)
+            return self._cell_array(cell_values)
+
+        starts = np.flatnonzero(np.r_[True, cell_id[1:] != cell_id[:-1]])
+        counts = np.diff(np.r_[starts, len(cell_id)])
+        array = np.full(self.m * self.n, np.nan)
+        array[cell_id[starts]] = reducer(values, starts, counts)
+        return array.reshape(self.m, self.n)
 
     def boolean_summary(self, func, dim):
         # TODO Might not be worth its own function...
         """
-        Calculates a column in self.data that is a boolean of whether or not that point is the point that corresponds \
-        to the function passed. For example, this can be used to create a boolean mask of points that are the minimum \
-        z point in their respective cell.
+        Calculates a boolean array of whether or not each point is the point that corresponds to the function passed. \
+        For example, this can be used to create a boolean mask of points that are the minimum z point in their \
+        respective cell.
 
         :param func: The function to calculate on each group.
         :param dim: The dimension of the point cloud as a string (x, y or z)
         """
+        index = self.cell_index
+        values = np.asarray(self._values(dim))
+        summary = index.groupby(values).transform(func).values
 
-        mask = self.data.groupby(['bins_x', 'bins_y'])[dim].transform(func) == self.data[dim]
+        mask = np.empty(len(values), dtype=bool)
+        mask[index.order] = summary == values[index.order]
         return mask
 
     @property
@@ -76,35 +348,35 @@ class Grid:
 
         return: An N x 2 numpy array where each row cooresponds to the [y x] coordinate of the empty cell.
         """
-        array = self.raster("count", "z").array
-        emptys = np.argwhere(np.isnan(array))
+        counts = self.cell_index.counts.reshape(self.m, self.n)
+        emptys = np.argwhere(counts == 0)
 
         return emptys
 
-    def interpolate(self, func, dim, interp_method="nearest"):
+    def interpolate(self, func, dim, interp_method="nearest", max_distance=None, hull=False):
         """
-        Interpolates missing cells in the grid. This function uses scipy.griddata as a backend. Please see \
-        documentation for that function for more details.
+        Interpolates missing cells in the grid. Only the empty cells are evaluated, see interpolation.fill_nan for \
+        more details.
 
         :param func: The function (or function string) to calculate an array on the gridded data.
         :param dim: The dimension (i.e. column name of self.cells) to cast func onto.
-        :param interp_method: The interpolation method call for scipy.griddata, one of any: "nearest", "cubic", \
-        "linear"
+        :param interp_method: The interpolation method, one of any: "nearest", "cubic", "linear"
+        :param max_distance: An optional distance in the units of the cloud, empty cells further than this from any \
+        non-empty cell are not filled.
+        :param hull: If True, empty cells outside of the convex hull of the non-empty cells are not filled.
 
         :return: An interpolated array.
         """
-        # Get points and values that we already have
-        cell_values = self.cells[dim].agg(func).reset_index()
+        if max_distance is not None:
+            max_distance = max_distance / self.cell_size
 
-        points = cell_values[['bins_x', 'bins_y']].values
-        values = cell_values[dim].values
+        def compute():
+            return fill_nan(self.raster(func, dim).array, interp_method, max_distance, hull)
 
-        # https://stackoverflow.com/questions/12864445/numpy-meshgrid-points
-        X, Y = np.mgrid[1:self.n+1, 1:self.m+1]
-
-        interp_grid = griddata(points, values, (X, Y), method=interp_method).T
-
-        return Raster(interp_grid, self)
+        if isinstance(func, str):
+            key = ("interpolate", func, dim, interp_method, max_distance, hull)
+            return Raster(self._memoized(key, (dim,), compute), self)
+        return Raster(compute(), self)
 
     def metrics(self, func_dict, as_raster = False):
         """
@@ -114,16 +386,20 @@ class Grid:
         correspond to the functions to be  called on those columns.
         :return: A pandas dataframe with the aggregated metrics.
         """
+        index = self.cell_index
+        columns = pd.DataFrame({dim: np.asarray(self._values(dim))[index.order] for dim in func_dict})
 
         # Aggregate on the function
-        aggregate = self.cells.agg(func_dict)
+        aggregate = columns.groupby(index.sorted_id, sort=False).agg(func_dict)
         if as_raster == False:
+            cell_id = np.asarray(aggregate.index, dtype=np.int64)
+            aggregate.index = pd.MultiIndex.from_arrays([cell_id % self.n, cell_id // self.n],
+                                                        names=['bins_x', 'bins_y'])
             return aggregate
         else:
             rasters = []
             for column in aggregate:
-                array = np.asarray(aggregate[column].reset_index().pivot('bins_y', 'bins_x'))
-                raster = Raster(array, self)
+                raster = Raster(self._cell_array(aggregate[column]), self)
                 rasters.append(raster)
             # Get list of dimension names
             dims = [tup[0] for tup in list(aggregate)]
@@ -131,25 +407,130 @@ class Grid:
             metrics = [tup[1] for tup in list(aggregate)]
             return pd.DataFrame({'dim': dims, 'metric': metrics, 'raster': rasters}).set_index(['dim', 'metric'])
 
-    def ground_filter(self, num_windows, dh_max, dh_0, interp_method = "nearest"):
+    def standard_metrics(self, dim="z", percentiles=DEFAULT_PERCENTILES, cover_threshold=2):
         """
-        Wrapper call for filter.zhang with convenient defaults.
+        Computes the standard set of area based metrics of every cell in one pass, see metrics.group_metrics. This \
+        is much faster than passing the equivalent functions to Grid.metrics.
+
+        :param dim: The dimension to compute the metrics on.
+        :param percentiles: The percentiles to compute.
+        :param cover_threshold: The cover band is the proportion of first returns above this value.
+        :return: A RasterStack object with one band per metric.
+        """
+        points = self.las.points
+        if "return_num" in points or "flag_byte" in points:
+            cover_mask = _return_mask(points, "first")
+        else:
+            cover_mask = None
+
+        cells, cell_metrics = group_metrics(self.cell_id, self._values(dim), percentiles, cover_threshold,
+                                            cover_mask)
+        stack = np.full((len(cell_metrics), self.m * self.n), np.nan)
+        for band, values in enumerate(cell_metrics.values()):
+            stack[band, cells] = values
+        return RasterStack(stack.reshape(-1, self.m, self.n), list(cell_metrics.keys()), self)
+
+    def pit_free_chm(self, thresholds=(0, 2, 5, 10, 15), max_edge=1.5, n_jobs=None):
+        """
+        Computes a pit free canopy height model from layered triangulations of the first returns, as in Khosravipour \
+        et al. (2014). Intended for normalized clouds. For each threshold the first returns at or above it are \
+        triangulated once and sampled at the cell centers. Triangles of every layer but the first with an edge \
+        longer than max_edge are dropped, so the upper layers do not bridge the gaps between crowns. The layers are \
+        built by a pool of threads and merged by their maximum.
+
+        Only the highest first return in each quarter of a cell is triangulated.
+
+        :param thresholds: The height thresholds of the layers, in increasing order.
+        :param max_edge: The maximum edge length of the triangles of the layers above the first.
+        :param n_jobs: The number of threads, by default the number of CPUs.
+        :return: A Raster object of the canopy height model, cells outside of the first layer are nan.
+        """
+        points = self.las.points
+        x, y, z = points["x"], points["y"], points["z"]
+        if "return_num" in points or "flag_byte" in points:
+            first = _return_mask(points, "first")
+            x, y, z = x[first], y[first], z[first]
+
+        # The highest point of each half cell sized sub cell
+        size = self.cell_size / 2
+        sub_col = np.clip(np.floor((x - self.las.min[0]) / size), 0, 2 * self.n - 1).astype(np.int64)
+        sub_row = np.clip(np.floor((y - self.las.min[1]) / size), 0, 2 * self.m - 1).astype(np.int64)
+        sub_cell = sub_row * 2 * self.n + sub_col
+        order = np.lexsort((z, sub_cell))
+        sorted_cell = sub_cell[order]
+        top = order[np.r_[sorted_cell[1:] != sorted_cell[:-1], True]] if len(order) > 0 else order
+        x, y, z = x[top], y[top], z[top]
+
+        def layer(threshold):
+            keep = z >= threshold
+            if np.count_nonzero(keep) < 3:
+                return None
+            edge = None if threshold == thresholds[0] else max_edge
+            try:
+                model = TerrainModel(x[keep], y[keep], z[keep], max_edge=edge)
+            except (ValueError, RuntimeError):
+                # Too few or collinear points to triangulate
+                return None
+            return model.rasterize(self, extrapolate=False, n_jobs=1).array
+
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        with ThreadPoolExecutor(n_jobs) as executor:
+            layers = [array for array in executor.map(layer, thresholds) if array is not None]
+
+        chm = np.full((self.m, self.n), np.nan)
+        for array in layers:
+            chm = np.fmax(chm, array)
+        return Raster(chm, self)
+
+    def ground_filter(self, num_windows=7, dh_max=2.5, dh_0=1, interp_method = "nearest", slope=None, method="zhang",
+                      rigidness=1):
+        """
+        Wrapper call for the ground filters with convenient defaults.
 
         Returns a Raster object corresponding to the filtered ground DEM of this particular grid.
-        :param type:
+        :param slope: The terrain slope used for the height thresholds, see filter.window_thresholds.
+        :param method: The ground filter, either "zhang", the progressive morphological filter of filter.zhang, or \
+        "csf", the cloth simulation filter of filter.csf. num_windows, dh_max, dh_0, interp_method and slope are only \
+        used by "zhang", rigidness only by "csf".
+        :param rigidness: The rigidness of the cloth, see filter.csf.
         :return:
         """
         # TODO Add functionality for classifying points as ground
-        # Get the interpolated DEM array.
-        dem_array = filter.zhang(self.interpolate("min", "z").array, num_windows,
-                                 dh_max, dh_0, self.cell_size, self, interp_method = interp_method)
+        # Get the interpolated DEM array, the DEM is memoized as long as z is not modified.
+        if method == "zhang":
+            key = ("ground_filter", method, num_windows, dh_max, dh_0, interp_method, slope)
+            compute = lambda: filter.zhang(self.interpolate("min", "z").array, num_windows, dh_max, dh_0,
+                                           self.cell_size, self, interp_method = interp_method, slope = slope)
+        elif method == "csf":
+            key = ("ground_filter", method, rigidness)
+            compute = lambda: filter.csf(self.raster("min", "z").array, rigidness, cell_size=self.cell_size)
+        else:
+            raise ValueError("method must be one of 'zhang' or 'csf'.")
+        dem_array = self._memoized(key, ("z",), compute)
         dem = Raster(dem_array, self)
 
         return dem
 
-    def normalize(self, num_windows, dh_max, dh_0, interp_method="nearest"):
+    def ground_elevation(self, dem, sampling="nearest"):
+        """
+        Samples an m x n array of this grid, i.e. a DEM, at each point.
+
+        :param dem: A 2D numpy array with the shape of this grid.
+        :param sampling: Either "nearest", the value of the cell of each point, or "bilinear", see \
+        interpolation.sample.
+        :return: A 1D numpy array with one value per point.
+        """
+        if sampling == "nearest":
+            return dem.ravel()[self.cell_id]
+        points = self.las.points
+        return sample(dem, points["x"], points["y"], self.las.min[0], self.las.min[1], self.cell_size, sampling)
+
+    def normalize(self, num_windows, dh_max, dh_0, interp_method="nearest", sampling="nearest", method="zhang"):
         """
-        Returns a new, normalized Grid object.
+        Returns a new, normalized Grid object. The parent cloud is not modified, see Cloud.normalize to normalize in \
+        place.
+        :param method: The ground filter, "zhang" or "csf", see Grid.ground_filter.
         :return:
         """
 
@@ -158,19 +539,11 @@ class Grid:
             strange results.")
 
         # Retrieve the DEM
-        dem = self.ground_filter(num_windows, dh_max, dh_0, interp_method)
-
-        # Organize the array into a dataframe and merge
-        df = pd.DataFrame(dem.array).stack().rename_axis(['bins_y', 'bins_x']).reset_index(name='val')
-        #df = pd.merge(self.data, df)
-
-        df = self.data.reset_index().merge(df, how = "left").set_index('index')
-        df['z'] = df['z'] - df['val']
+        dem = self.ground_filter(num_windows, dh_max, dh_0, interp_method, method=method)
 
         # Initialize new grid object
         ground_grid = Grid(self.cloud, self.cell_size)
-        ground_grid.data = df
-        ground_grid.cells = ground_grid.data.groupby(['bins_x', 'bins_y'])
+        ground_grid.data["z"] = ground_grid.data["z"].values - self.ground_elevation(dem.array, sampling)
 
         return ground_grid
 
@@ -184,7 +557,7 @@ class Raster:
     def _affine(self):
         """Constructs the affine transformation, used for plotting and exporting polygons and rasters."""
         from rasterio.transform import from_origin
-        affine = from_origin(self.grid.las.min[0], self.grid.las.max[1], self.grid.cell_size, self.grid.cell_size)
+        affine = from_origin(self.grid.las.min[0], self.grid._max_y, self.grid.cell_size, self.grid.cell_size)
         return affine
 
     @property
@@ -226,8 +599,9 @@ class Raster:
         ax.set_xticks(np.linspace(0, self.grid.n, 3))
         ax.set_yticks(np.linspace(0, self.grid.m, 3))
 
-        x_ticks, y_ticks = np.rint(np.linspace(self.grid.las.min[0], self.grid.las.max[0], 3)), \
-                           np.rint(np.linspace(self.grid.las.min[1], self.grid.las.max[1], 3))
+        max_x = self.grid.las.min[0] + self.grid.n * self.cell_size
+        x_ticks, y_ticks = np.rint(np.linspace(self.grid.las.min[0], max_x, 3)), \
+                           np.rint(np.linspace(self.grid.las.min[1], self.grid._max_y, 3))
 
         ax.set_xticklabels(x_ticks)
         ax.set_yticklabels(y_ticks)
@@ -269,6 +643,41 @@ class Raster:
             return(tops_raster)
 
 
+    def variable_window_maxima(self, window=None, threshold_abs=2):
+        """
+        Detects tree tops as the cells that are the maximum of a circular window whose size depends on their height, \
+        as in Popescu and Wynne (2004). The window of each cell above threshold_abs is scanned in a compiled kernel \
+        that stops at the first higher cell, so most cells cost far less than their window. Adjacent cells with the \
+        same height that are both maxima are one top.
+
+        :param window: A function that takes an array of heights and returns the window diameter at each height, in \
+        the units of the cloud. By default the crown width of pines in Popescu and Wynne (2004), \
+        3.09632 + 0.00895 * h ** 2.
+        :param threshold_abs: The minimum height of a top.
+        :return: A pandas DataFrame with the x, y and height of each top.
+        """
+        from scipy.ndimage import label
+
+        if window is None:
+            window = lambda h: 3.09632 + 0.00895 * h**2
+
+        array = np.where(np.isnan(self.array), -np.inf, self.array)
+        rows, cols = np.nonzero(array >= threshold_abs)
+        radius = np.maximum(np.round(window(array[rows, cols]) / 2 / self.cell_size), 1).astype(np.int64)
+
+        tops = np.zeros(array.shape, dtype=bool)
+        tops[rows, cols] = _window_maxima(array, rows, cols, radius)
+
+        # Keep the first cell of each group of adjacent tops
+        labels = label(tops, structure=np.ones((3, 3)))[0]
+        uniq, first = np.unique(labels.ravel(), return_index=True)
+        first = first[uniq != 0]
+        rows, cols = np.unravel_index(first, array.shape)
+
+        return pd.DataFrame({"x": self.grid.las.min[0] + (cols + 0.5) * self.cell_size,
+                             "y": self.grid.las.min[1] + (rows + 0.5) * self.cell_size,
+                             "height": array[rows, cols]}, columns=["x", "y", "height"])
+
     def watershed_seg(self, min_distance=2, threshold_abs=2, classify=False, plot = False):
         """
         Returns the watershed segmentation of the Raster as a geopandas dataframe.
@@ -292,13 +701,13 @@ class Raster:
         labels = watershed(-watershed_array, tops, mask=watershed_array)
 
         if classify == True:
-            xy = self.grid.data[["bins_x", "bins_y"]].values
-            tree_id = labels[xy[:, 1], xy[:, 0]]
+            tree_id = labels.ravel()[self.grid.cell_id]
 
             # Update the CloudData and Grid objects
             self.grid.las.points["user_data"] = tree_id
-            self.grid.data = self.grid.las.points
-            self.grid.cells = self.grid.data.groupby(['bins_x', 'bins_y'])
+            if self.grid._data is not None:
+                self.grid._data["user_data"] = tree_id
+                self.grid.cells = None
 
         if plot == False:
             affine = self._affine
@@ -315,15 +724,27 @@ class Raster:
             plt.ylim((0, self.array.shape[0]))
             ax.invert_yaxis()
 
-    def pit_filter(self, kernel_size):
+    def pit_filter(self, kernel_size, n_jobs=None):
         """
-        Filters pits in the raster. Intended for use with canopy height models (i.e. grid(0.5).interpolate("max", "z").
+        Filters pits in the raster with a median filter that ignores nan cells, see filter.median_filter. Intended for \
+        use with canopy height models (i.e. grid(0.5).interpolate("max", "z").
         This function modifies the raster array **in place**.
         
         :param kernel_size: The size of the kernel window to pass over the array. For example 3 -> 3x3 kernel window.
+        :param n_jobs: The number of threads, by default the number of CPUs.
+        """
+        self.array = filter.median_filter(self.array, kernel_size, n_jobs=n_jobs)
+
+    def sample(self, x, y, method="nearest"):
+        """
+        Samples the raster at point coordinates, see interpolation.sample.
+
+        :param x: A 1D numpy array of x coordinates.
+        :param y: A 1D numpy array of y coordinates.
+        :param method: Either "nearest" or "bilinear".
+        :return: A 1D numpy array of the sampled values.
         """
-        from scipy.signal import medfilt
-        self.array = medfilt(self.array, kernel_size=kernel_size)
+        return sample(self.array, x, y, self.grid.las.min[0], self.grid.las.min[1], self.cell_size, method)
 
     def write(self, path):
         """
@@ -333,10 +754,41 @@ class Raster:
         :param path: The path to write to.
         """
 
-        gisexport.array_to_raster(self.array, self.cell_size, self.grid.las.min[0], self.grid.las.max[1],
+        gisexport.array_to_raster(self.array, self.cell_size, self.grid.las.min[0], self.grid._max_y,
                                       self.grid.cloud.crs, path)
 
 
+class RasterStack:
+    """
+    A multi-band raster, each band is an m x n array of the same Grid, i.e. the output of Grid.standard_metrics.
+
+    :param array: A 3D numpy array of shape (bands, m, n).
+    :param names: A list of the name of each band.
+    :param grid: The Grid the bands were computed on.
+    """
+    def __init__(self, array, names, grid):
+        self.array = array
+        self.names = list(names)
+        self.grid = grid
+        self.cell_size = self.grid.cell_size
+
+    def __getitem__(self, name):
+        """Returns the band with the given name as a Raster."""
+        return Raster(self.array[self.names.index(name)], self.grid)
+
+    def __len__(self):
+        return len(self.names)
+
+    def write(self, path):
+        """
+        Writes the stack to a multi-band GeoTIFF, the bands are written in the order of RasterStack.names. Requires \
+        the Cloud.crs attribute to be filled by a projection string (ideally wkt or proj4).
+
+        :param path: The path to write to.
+        """
+        gisexport.array_to_raster(self.array, self.cell_size, self.grid.las.min[0], self.grid._max_y,
+                                  self.grid.cloud.crs, path)
+
 class DetectedTops(Raster):
     """
     This class is for visualization of detected tops with a raster object.
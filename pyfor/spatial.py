@@ -0,0 +1,94 @@
+# Space filling curves used to order points for better memory locality in spatial operations.
+
+import numpy as np
+
+def _quantize(x, y, min_xy, cell_size, bits):
+    """
+    Converts coordinates to integer cell coordinates clipped to [0, 2**bits).
+    """
+    top = 2**bits - 1
+    ix = np.clip(np.floor((x - min_xy[0]) / cell_size), 0, top).astype(np.uint64)
+    iy = np.clip(np.floor((y - min_xy[1]) / cell_size), 0, top).astype(np.uint64)
+    return ix, iy
+
+def _spread_bits(v):
+    """
+    Spreads the lower 32 bits of each integer so that there is a zero bit between each bit, i.e. 0b1011 -> 0b1000101.
+    """
+    v = v & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+def morton_code(ix, iy):
+    """
+    Computes the Morton (Z-order) code of integer cell coordinates by interleaving their bits.
+
+    :param ix: A 1D array of non-negative integer column indices.
+    :param iy: A 1D array of non-negative integer row indices.
+    :return: A 1D uint64 array of Morton codes.
+    """
+    ix = np.asarray(ix).astype(np.uint64)
+    iy = np.asarray(iy).astype(np.uint64)
+    return _spread_bits(ix) | (_spread_bits(iy) << np.uint64(1))
+
+def hilbert_code(ix, iy, bits):
+    """
+    Computes the distance along a Hilbert curve of integer cell coordinates. The Hilbert curve preserves locality \
+    better than the Morton curve as consecutive codes are always adjacent cells.
+
+    :param ix: A 1D array of integer column indices in [0, 2**bits).
+    :param iy: A 1D array of integer row indices in [0, 2**bits).
+    :param bits: The number of bits of each coordinate, the order of the curve.
+    :return: A 1D uint64 array of Hilbert distances.
+    """
+    x = np.asarray(ix).astype(np.int64)
+    y = np.asarray(iy).astype(np.int64)
+    d = np.zeros(len(x), dtype=np.uint64)
+    s = 2**(bits - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += (np.uint64(s) * np.uint64(s)) * ((3 * rx) ^ ry).astype(np.uint64)
+
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s //= 2
+    return d
+
+def curve_order(x, y, curve="hilbert", cell_size=None, bits=16):
+    """
+    Returns the permutation that sorts points along a space filling curve.
+
+    :param x: A 1D array of x coordinates.
+    :param y: A 1D array of y coordinates.
+    :param curve: One of "hilbert" or "morton".
+    :param cell_size: The size of the cells that are ordered along the curve, in the units of x and y. Points in the \
+    same cell keep their relative order. By default, the extent is divided into 2**bits cells along its longest axis.
+    :param bits: The number of bits per axis, used when cell_size is not given. Must be at most 32.
+    :return: A 1D array of indices.
+    """
+    min_xy = (np.min(x), np.min(y))
+    extent = max(np.max(x) - min_xy[0], np.max(y) - min_xy[1])
+    if cell_size is None:
+        cell_size = extent / (2**bits - 1) if extent > 0 else 1
+    else:
+        bits = max(1, int(np.ceil(np.log2(extent / cell_size + 1))))
+        if bits > 32:
+            raise ValueError("cell_size is too small for the extent of the points.")
+
+    ix, iy = _quantize(x, y, min_xy, cell_size, bits)
+    if curve == "morton":
+        codes = morton_code(ix, iy)
+    elif curve == "hilbert":
+        codes = hilbert_code(ix, iy, bits)
+    else:
+        raise ValueError("curve must be one of 'hilbert' or 'morton'.")
+    return np.argsort(codes, kind="mergesort")
@@ -0,0 +1,165 @@
+# A triangulated terrain model that is built once and sampled many times.
+
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import Delaunay, cKDTree
+
+from pyfor.spatial import curve_order
+
+class TerrainModel:
+    """
+    A triangulated irregular network (TIN) of ground elevations. The Delaunay triangulation is built once, after \
+    which any number of points or rasters can be sampled from it. TerrainModel objects can be pickled, see \
+    TerrainModel.save and TerrainModel.load.
+    """
+    def __init__(self, x, y, z, max_edge=None):
+        """
+        :param x: A 1D array of the x coordinates of the ground points or cells.
+        :param y: A 1D array of the y coordinates of the ground points or cells.
+        :param z: A 1D array of the ground elevation of each point or cell.
+        :param max_edge: An optional maximum edge length, triangles with a longer edge are treated as outside of the \
+        triangulation.
+        """
+        self.z = np.asarray(z, dtype=np.float64)
+        self.tin = Delaunay(np.column_stack((x, y)))
+        # The barycentric transforms are computed lazily by scipy, compute them before any threads use them
+        self.tin.transform
+        self._kdtree = None
+
+        self.valid = None
+        if max_edge is not None:
+            corners = self.tin.points[self.tin.simplices]
+            edges = corners - np.roll(corners, 1, axis=1)
+            self.valid = np.max(np.hypot(edges[:, :, 0], edges[:, :, 1]), axis=1) <= max_edge
+
+    @classmethod
+    def from_raster(cls, raster):
+        """
+        Builds a TerrainModel from the cell centers of a DEM Raster, i.e. one returned by Grid.ground_filter. Cells \
+        with nan are skipped.
+
+        :param raster: A Raster object.
+        """
+        rows, cols = np.nonzero(~np.isnan(raster.array))
+        x = raster.grid.las.min[0] + (cols + 0.5) * raster.cell_size
+        y = raster.grid.las.min[1] + (rows + 0.5) * raster.cell_size
+        return cls(x, y, raster.array[rows, cols])
+
+    @classmethod
+    def from_cloud(cls, cloud, ground_class=2):
+        """
+        Builds a TerrainModel from the ground points of a classified cloud, i.e. one classified with \
+        Cloud.classify_ground.
+
+        :param cloud: A Cloud object.
+        :param ground_class: The classification of the ground points.
+        """
+        points = cloud.las.points
+        ground = np.asarray(points["classification"]) == ground_class
+        if not ground.any():
+            raise ValueError("The cloud has no points with classification {}.".format(ground_class))
+        return cls(points["x"][ground], points["y"][ground], points["z"][ground])
+
+    @property
+    def kdtree(self):
+        """A KD tree of the vertices, used for points outside of the triangulation."""
+        if self._kdtree is None:
+            self._kdtree = cKDTree(self.tin.points)
+        return self._kdtree
+
+    def _sample_chunk(self, xy, extrapolate):
+        """
+        Interpolates the elevation of a 2D array of coordinates from the barycentric coordinates of their triangles.
+        """
+        simplex = self.tin.find_simplex(xy)
+        inside = simplex >= 0
+        if self.valid is not None:
+            inside[inside] = self.valid[simplex[inside]]
+        values = np.full(len(xy), np.nan)
+
+        transform = self.tin.transform[simplex[inside]]
+        b = np.einsum("ijk,ik->ij", transform[:, :2], xy[inside] - transform[:, 2])
+        weights = np.column_stack((b, 1 - b.sum(axis=1)))
+        values[inside] = np.sum(weights * self.z[self.tin.simplices[simplex[inside]]], axis=1)
+
+        if extrapolate and not inside.all():
+            nearest = self.kdtree.query(xy[~inside])[1]
+            values[~inside] = self.z[nearest]
+        return values
+
+    def sample(self, x, y, extrapolate=True, chunk_size=250000, n_jobs=None):
+        """
+        Samples the elevation of the model at point coordinates. The points are ordered along a space filling curve, \
+        so that consecutive points are found with short walks through the triangulation, and processed in chunks \
+        by a pool of threads.
+
+        :param x: A 1D array of x coordinates.
+        :param y: A 1D array of y coordinates.
+        :param extrapolate: If True, points outside of the triangulation, or in triangles longer than max_edge, take \
+        the elevation of the closest vertex, otherwise they are nan.
+        :param chunk_size: The number of points processed by each task.
+        :param n_jobs: The number of threads, by default the number of CPUs.
+        :return: A 1D array with the elevation of each point.
+        """
+        xy = np.column_stack((np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)))
+        values = np.empty(len(xy))
+        if len(xy) == 0:
+            return values
+
+        order = curve_order(xy[:, 0], xy[:, 1], curve="morton", bits=12)
+        chunks = [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+        def task(chunk):
+            values[chunk] = self._sample_chunk(xy[chunk], extrapolate)
+
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        if n_jobs == 1 or len(chunks) == 1:
+            for chunk in chunks:
+                task(chunk)
+        else:
+            with ThreadPoolExecutor(n_jobs) as executor:
+                list(executor.map(task, chunks))
+        return values
+
+    def rasterize(self, grid, extrapolate=True, n_jobs=None):
+        """
+        Samples the model at the cell centers of a Grid, of any cell size, without triangulating again.
+
+        :param grid: A Grid object, i.e. from Cloud.grid.
+        :param extrapolate: See TerrainModel.sample.
+        :param n_jobs: The number of threads, by default the number of CPUs.
+        :return: A Raster object.
+        """
+        from pyfor.rasterizer import Raster
+        x = grid.las.min[0] + (np.arange(grid.n) + 0.5) * grid.cell_size
+        y = grid.las.min[1] + (np.arange(grid.m) + 0.5) * grid.cell_size
+        xx, yy = np.meshgrid(x, y)
+        array = self.sample(xx.ravel(), yy.ravel(), extrapolate, n_jobs=n_jobs).reshape(grid.m, grid.n)
+        return Raster(array, grid)
+
+    def save(self, path):
+        """
+        Writes this model to a file, including its triangulation.
+
+        :param path: The path of the output file.
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a model written with TerrainModel.save.
+
+        :param path: The path of the file.
+        :return: A TerrainModel object.
+        """
+        with open(path, "rb") as f:
+            model = pickle.load(f)
+        if not isinstance(model, TerrainModel):
+            raise ValueError("{} does not contain a TerrainModel.".format(path))
+        return model
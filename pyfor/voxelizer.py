@@ -21,7 +21,7 @@ class VoxelGrid:
         bins_y = np.searchsorted(np.linspace(min_y, max_y, self.m), self.cloud.las.points["y"])
         bins_z = np.searchsorted(np.linspace(min_z, max_z, self.p), self.cloud.las.points["z"])
 
-        self.data = self.cloud.las.points
+        self.data = self.cloud.las.points.to_pandas()
         self.data["bins_x"] = bins_x
         self.data["bins_y"] = bins_y
         self.data["bins_z"] = bins_z
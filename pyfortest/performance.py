@@ -1,14 +1,402 @@
 # This tests the performance of different functions on a small data set.
 
+import os
+import sys
 import time
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+import laspy
 import pyfor
 
+data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+test_las = os.path.join(data_dir, 'test.las')
+
 def time_func(func_string):
     start = time.time()
     eval(func_string)
     end = time.time()
     return(end - start)
 
+def _measure_child(queue, func, args):
+    start = time.time()
+    func(*args)
+    end = time.time()
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak = peak * 1024
+    queue.put((end - start, peak))
+
+def measure(func, *args):
+    """
+    Runs func(*args) in a fresh process and returns a tuple of the elapsed time in seconds and the peak resident set \
+    size in megabytes of that process.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_child, args=(queue, func, args))
+    process.start()
+    elapsed, peak = queue.get()
+    process.join()
+    return(elapsed, peak / 1e6)
+
+def _load_dataframe(path):
+    """The pre 0.3 loading path, every dimension is copied into a pandas DataFrame."""
+    las = laspy.file.File(path)
+    points = pd.DataFrame({"x": las.x, "y": las.y, "z": las.z, "intensity": las.intensity,
+                           "return_num": las.return_num, "classification": las.classification,
+                           "flag_byte": las.flag_byte, "scan_angle_rank": las.scan_angle_rank,
+                           "user_data": las.user_data, "pt_src_id": las.pt_src_id})
+    return pyfor.cloud.CloudData(points, las.header)
+
+def _load_columnar(path):
+    return pyfor.cloud.Cloud(path)
+
+def bench_load(path=test_las):
+    """Compares load time and peak memory of the DataFrame and columnar loading paths."""
+    for name, func in [("DataFrame", _load_dataframe), ("Columnar", _load_columnar)]:
+        elapsed, peak = measure(func, path)
+        print('Load {} - {:.3f} s, peak RSS {:.1f} MB'.format(name, elapsed, peak))
+
+def _open_header_query(path, lazy):
+    pc = pyfor.cloud.Cloud(path, lazy=lazy)
+    return pc.las.min, pc.las.max, pc.las.count
+
+def bench_lazy_open(path=test_las):
+    """Compares the cost of a header only query on an eagerly and a lazily loaded cloud."""
+    for lazy in [False, True]:
+        elapsed, peak = measure(_open_header_query, path, lazy)
+        print('Open and query header (lazy={}) - {:.3f} s, peak RSS {:.1f} MB'.format(lazy, elapsed, peak))
+
+def bench_dims(path=test_las):
+    """Load time and peak memory for common subsets of dimensions."""
+    subsets = [["x", "y", "z"], ["classification"], ["classification", "return_num", "intensity"], None]
+    for dims in subsets:
+        elapsed, peak = measure(pyfor.cloud.Cloud, path, False, dims)
+        print('Load dims={} - {:.3f} s, peak RSS {:.1f} MB'.format(dims, elapsed, peak))
+
+def _stream_filter(path, out_path, chunk_size):
+    with pyfor.lasio.LasWriter(out_path, path) as writer:
+        for chunk in pyfor.cloud.Cloud.iter_chunks(path, chunk_size=chunk_size):
+            keep = chunk.points["z"] > np.median(chunk.points["z"])
+            writer.write(chunk.points[keep])
+
+def bench_chunks(path=test_las, out_path="temp_bench_chunks.las"):
+    """Peak memory of a streaming filter for different chunk sizes."""
+    for chunk_size in [100000, 1000000, 5000000]:
+        elapsed, peak = measure(_stream_filter, path, out_path, chunk_size)
+        print('Stream filter chunk_size={} - {:.3f} s, peak RSS {:.1f} MB'.format(chunk_size, elapsed, peak))
+    os.remove(out_path)
+
+def _clip_after_load(path, bounds):
+    pc = pyfor.cloud.Cloud(path)
+    return pc.las.points[pyfor.clip_funcs.square_clip(pc, bounds)]
+
+def _clip_at_read(path, bounds):
+    return pyfor.cloud.Cloud(path, bounds=bounds)
+
+def bench_plot_extraction(path=test_las, plot_size=20):
+    """Compares clipping a square plot from the center of a tile after loading and while reading."""
+    header = pyfor.lasio.read_header(path)
+    center_x, center_y = (header.min[0] + header.max[0]) / 2, (header.min[1] + header.max[1]) / 2
+    bounds = (center_x - plot_size / 2, center_y - plot_size / 2, center_x + plot_size / 2, center_y + plot_size / 2)
+    for name, func in [("after load", _clip_after_load), ("at read", _clip_at_read)]:
+        elapsed, peak = measure(func, path, bounds)
+        print('Extract {} m plot {} - {:.3f} s, peak RSS {:.1f} MB'.format(plot_size, name, elapsed, peak))
+
+def bench_spatial_sort(path=test_las, cell_size=1):
+    """Compares gridding and clipping a cloud in acquisition order and sorted along the Hilbert curve."""
+    original = pyfor.cloud.Cloud(path)
+    spatially_sorted = pyfor.cloud.Cloud(path)
+    start = time.time()
+    spatially_sorted.sort_spatial()
+    print('Hilbert sort - {:.3f} s'.format(time.time() - start))
+
+    min_x, min_y = original.las.min[0], original.las.min[1]
+    bounds = (min_x, min_y, min_x + 50, min_y + 50)
+    for name, pc in [("acquisition order", original), ("hilbert order", spatially_sorted)]:
+        start = time.time()
+        pc.grid(cell_size).raster("max", "z")
+        grid_time = time.time() - start
+        start = time.time()
+        pc.las.points[pyfor.clip_funcs.square_clip(pc, bounds)]
+        clip_time = time.time() - start
+        print('{} - grid {:.3f} s, clip {:.3f} s'.format(name, grid_time, clip_time))
+
+def bench_index(path=test_las, n_queries=100, plot_size=20):
+    """Compares repeated plot queries on a tile with and without a spatial index."""
+    header = pyfor.lasio.read_header(path)
+    corners = np.random.uniform([header.min[0], header.min[1]], [header.max[0] - plot_size, header.max[1] - plot_size],
+                                size=(n_queries, 2))
+    queries = [(x, y, x + plot_size, y + plot_size) for x, y in corners]
+
+    start = time.time()
+    index = pyfor.lasindex.build_index(path)
+    print('Build index - {:.3f} s, {} intervals'.format(time.time() - start, index.n_intervals))
+
+    start = time.time()
+    for bounds in queries:
+        index.read(path, bounds, header)
+    print('{} indexed queries - {:.3f} s'.format(n_queries, time.time() - start))
+
+    start = time.time()
+    for bounds in queries:
+        pyfor.lasio.read_clipped(path, bounds, header)
+    print('{} full scan queries - {:.3f} s'.format(n_queries, time.time() - start))
+    os.remove(pyfor.lasindex.index_path(path))
+
+def bench_cache(path=test_las, cache_dir="temp_bench_cache"):
+    """Compares loading a file directly and through a warm cache.DiskCache."""
+    disk_cache = pyfor.cache.DiskCache(cache_dir)
+    pyfor.cloud.Cloud(path, cache=disk_cache)
+    for name, func, args in [("decoded", pyfor.cloud.Cloud, (path,)),
+                             ("cached", pyfor.cloud.Cloud, (path, False, None, None, None, disk_cache))]:
+        elapsed, peak = measure(func, *args)
+        print('Load {} - {:.3f} s, peak RSS {:.1f} MB'.format(name, elapsed, peak))
+    disk_cache.clear()
+    os.rmdir(cache_dir)
+
+def bench_integer_coords(path=test_las):
+    """Compares load time and peak memory of float and scaled integer coordinates."""
+    for integer_coords in [False, True]:
+        elapsed, peak = measure(pyfor.cloud.Cloud, path, False, ["x", "y", "z"], None, None, None, integer_coords)
+        print('Load integer_coords={} - {:.3f} s, peak RSS {:.1f} MB'.format(integer_coords, elapsed, peak))
+
+
+def _chained_filters(path):
+    cloud = pyfor.cloud.Cloud(path)
+    cloud.filter(0, 100, "z")
+    cloud.filter(0, 200, "intensity")
+    cloud.filter(0, 3, "return_num")
+    return cloud.las.points["z"]
+
+def bench_filter_chain(path=test_las):
+    """Times a chain of filters, each dimension is only gathered once when it is read."""
+    elapsed, peak = measure(_chained_filters, path)
+    print('Chained filters - {:.3f} s, peak RSS {:.1f} MB'.format(elapsed, peak))
+
+def _grid_raster(path, cell_size):
+    cloud = pyfor.cloud.Cloud(path)
+    return cloud.grid(cell_size).raster("max", "z")
+
+def bench_grid(path=test_las):
+    """Times grid construction and a maximum z raster at several cell sizes."""
+    for cell_size in [0.25, 0.5, 1, 10]:
+        elapsed, peak = measure(_grid_raster, path, cell_size)
+        print('Grid and raster - {} - {:.3f} s, peak RSS {:.1f} MB'.format(cell_size, elapsed, peak))
+
+def _raster_reducers(path, cell_size, fast):
+    grid = pyfor.cloud.Cloud(path).grid(cell_size)
+    for func in ["max", "min", "mean", "sum", "count", "std"]:
+        if fast:
+            grid.raster(func, "z")
+        else:
+            # A lambda is not recognized as a fast reducer, so pandas is used
+            grid.raster(lambda z, func=func: getattr(z, func)(), "z")
+
+def bench_raster_reducers(path=test_las):
+    """Compares the fast reducers of Grid.raster against pandas at several cell sizes."""
+    for cell_size in [0.25, 0.5, 1, 10]:
+        for fast in [False, True]:
+            elapsed, peak = measure(_raster_reducers, path, cell_size, fast)
+            print('Raster reducers - {} - fast={} - {:.3f} s, peak RSS {:.1f} MB'.format(cell_size, fast, elapsed,
+                                                                                          peak))
+
+def _metrics(path, cell_size, one_pass):
+    grid = pyfor.cloud.Cloud(path).grid(cell_size)
+    if one_pass:
+        grid.standard_metrics()
+    else:
+        percentiles = [lambda z, p=p: np.percentile(z, p) for p in [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]]
+        grid.metrics({"z": ["count", "mean", "std", "skew", pd.Series.kurt, "min", "max"] + percentiles},
+                     as_raster=True)
+
+def bench_metrics(path=test_las):
+    """Compares Grid.standard_metrics against the equivalent Grid.metrics call."""
+    for cell_size in [1, 10, 20]:
+        for one_pass in [False, True]:
+            elapsed, peak = measure(_metrics, path, cell_size, one_pass)
+            print('Metrics - {} - one_pass={} - {:.3f} s, peak RSS {:.1f} MB'.format(cell_size, one_pass, elapsed,
+                                                                                      peak))
+
+def _plot_metrics(path, plots, one_pass):
+    cloud = pyfor.cloud.Cloud(path)
+    if one_pass:
+        cloud.polygon_metrics(plots)
+    else:
+        for plot in plots:
+            cloud.clip(plot).las.points.to_pandas()["z"].describe()
+
+def bench_polygon_metrics(path=test_las, n_plots=1000, radius=5):
+    """Compares Cloud.polygon_metrics against clipping each plot."""
+    from shapely.geometry import Point
+    header = pyfor.lasio.read_header(path)
+    state = np.random.RandomState(0)
+    plots = [Point(x, y).buffer(radius) for x, y in zip(state.uniform(header.min[0], header.max[0], n_plots),
+                                                        state.uniform(header.min[1], header.max[1], n_plots))]
+    for one_pass in [False, True]:
+        elapsed, peak = measure(_plot_metrics, path, pd.Series(plots), one_pass)
+        print('Plot metrics - {} plots - one_pass={} - {:.3f} s, peak RSS {:.1f} MB'.format(n_plots, one_pass,
+                                                                                          elapsed, peak))
+
+def _repeated_chm(path, cell_size, repeats):
+    cloud = pyfor.cloud.Cloud(path)
+    for i in range(repeats):
+        cloud.chm(cell_size, interp_method="nearest")
+
+def bench_repeated_chm(path=test_las, cell_size=0.5):
+    """Times one and ten interpolated canopy height models at the same cell size."""
+    for repeats in [1, 10]:
+        elapsed, peak = measure(_repeated_chm, path, cell_size, repeats)
+        print('Repeated chm - {} x {} - {:.3f} s, peak RSS {:.1f} MB'.format(repeats, cell_size, elapsed, peak))
+
+def _griddata_fill(array, method):
+    """The pre 0.3 interpolation, every cell of the array is evaluated."""
+    from scipy.interpolate import griddata
+    known = np.nonzero(np.isfinite(array))
+    rows, cols = np.mgrid[0:array.shape[0], 0:array.shape[1]]
+    return griddata(np.stack(known, axis=1), array[known], (rows, cols), method=method)
+
+def bench_interpolate(path=test_las, cell_size=0.5):
+    """Compares filling the empty cells of a canopy height model with griddata and interpolation.fill_nan."""
+    array = pyfor.cloud.Cloud(path).grid(cell_size).raster("max", "z").array
+    for method in ["nearest", "linear"]:
+        for func in [_griddata_fill, pyfor.interpolation.fill_nan]:
+            elapsed, peak = measure(func, array, method)
+            print('Interpolate - {} - {} - {:.3f} s, peak RSS {:.1f} MB'.format(method, func.__name__, elapsed, peak))
+
+def _normalize_merge(path, cell_size):
+    """The pre 0.3 normalization, the DEM is merged into a DataFrame copy of the points."""
+    cloud = pyfor.cloud.Cloud(path)
+    grid = cloud.grid(cell_size)
+    dem = grid.ground_filter(7, 2.5, 1)
+    df = pd.DataFrame(dem.array).stack().rename_axis(['bins_y', 'bins_x']).reset_index(name='val')
+    df = grid.data.reset_index().merge(df, how="left").set_index('index')
+    cloud.las.points["z"] = (df['z'] - df['val']).values
+
+def _normalize_in_place(path, cell_size, sampling):
+    pyfor.cloud.Cloud(path).normalize(cell_size, sampling=sampling)
+
+def bench_normalize(path=test_las, cell_size=1):
+    """Compares the merge based normalization against in place normalization, i.e. on a 50M point tile."""
+    elapsed, peak = measure(_normalize_merge, path, cell_size)
+    print('Normalize - merge - {:.3f} s, peak RSS {:.1f} MB'.format(elapsed, peak))
+    for sampling in ["nearest", "bilinear"]:
+        elapsed, peak = measure(_normalize_in_place, path, cell_size, sampling)
+        print('Normalize - in place {} - {:.3f} s, peak RSS {:.1f} MB'.format(sampling, elapsed, peak))
+
+def _zhang_loop(array, number_of_windows, dh_max, dh_0, c, grid, interp_method="nearest"):
+    """The pre 0.3 implementation of filter.zhang, which tests each cell in turn."""
+    from scipy.ndimage import grey_opening
+    w_k_list = list(map(pyfor.filter.window_size, range(number_of_windows)))
+    A = array
+    flag = np.zeros(A.shape)
+    for k, w_k in enumerate(w_k_list):
+        opened = grey_opening(A, (w_k, w_k))
+        w_k_1 = 0 if k == 0 else w_k_list[k - 1]
+        for i in range(A.shape[0]):
+            dh_t = pyfor.filter.dht(A[i, :], w_k, w_k_1, dh_0, dh_max, c)
+            for j in range(A.shape[1]):
+                if A[i, j] - opened[i, j] > dh_t:
+                    flag[i, j] = w_k
+            A[i, :] = opened[i, :]
+    if np.sum(flag) == 0:
+        return None
+    empty = grid.empty_cells
+    A[empty[:, 0], empty[:, 1]] = np.nan
+    return pyfor.interpolation.fill_nan(np.where(flag != 0, A, np.nan), interp_method)
+
+def bench_zhang(path=test_las):
+    """Compares the vectorized filter.zhang against the cell by cell loop, and checks that they are identical."""
+    for cell_size in [0.5, 1]:
+        grid = pyfor.cloud.Cloud(path).grid(cell_size)
+        array = grid.interpolate("min", "z").array
+        results = []
+        for func in [_zhang_loop, pyfor.filter.zhang]:
+            start = time.time()
+            results.append(func(array.copy(), 7, 2.5, 1, cell_size, grid))
+            print('Zhang - {} - {} - {:.3f} s'.format(cell_size, func.__name__, time.time() - start))
+        if results[0] is None or results[1] is None:
+            # No ground cells were classified
+            identical = results[0] is None and results[1] is None
+        else:
+            identical = np.array_equal(results[0], results[1], equal_nan=True)
+        print('Zhang - {} - identical: {}'.format(cell_size, identical))
+
+def bench_pit_filter(path=test_las, cell_size=0.25):
+    """Compares scipy.signal.medfilt against filter.median_filter on a canopy height model."""
+    from scipy.signal import medfilt
+    array = pyfor.cloud.Cloud(path).chm(cell_size, interp_method="nearest").array
+    pyfor.filter.median_filter(array[:10, :10], 3)
+    for kernel_size in [3, 5, 9]:
+        start = time.time()
+        medfilt(array, kernel_size)
+        print('Pit filter - {} - medfilt - {:.3f} s'.format(kernel_size, time.time() - start))
+        start = time.time()
+        pyfor.filter.median_filter(array, kernel_size)
+        print('Pit filter - {} - median_filter - {:.3f} s'.format(kernel_size, time.time() - start))
+
+def _median_chm(path, cell_size):
+    pyfor.cloud.Cloud(path).chm(cell_size, interp_method="nearest", pit_filter="median", kernel_size=5)
+
+def _pit_free_chm(path, cell_size, n_jobs):
+    pyfor.cloud.Cloud(path).grid(cell_size).pit_free_chm(n_jobs=n_jobs)
+
+def bench_pit_free_chm(path=test_las, cell_size=0.5):
+    """Compares a median filtered canopy height model against pit free ones built on one thread and on all CPUs."""
+    elapsed, peak = measure(_median_chm, path, cell_size)
+    print('Pit free CHM - median - {:.3f} s, peak RSS {:.1f} MB'.format(elapsed, peak))
+    for n_jobs in [1, None]:
+        elapsed, peak = measure(_pit_free_chm, path, cell_size, n_jobs)
+        print('Pit free CHM - pit_free, n_jobs={} - {:.3f} s, peak RSS {:.1f} MB'.format(n_jobs, elapsed, peak))
+
+def bench_local_maxima(path=test_las, cell_size=0.5):
+    """Compares Raster.local_maxima against Raster.variable_window_maxima on a canopy height model."""
+    chm = pyfor.cloud.Cloud(path).chm(cell_size, interp_method="nearest")
+    chm.variable_window_maxima()
+    start = time.time()
+    chm.local_maxima()
+    print('Local maxima - local_maxima - {:.3f} s'.format(time.time() - start))
+    start = time.time()
+    tops = chm.variable_window_maxima()
+    print('Local maxima - variable_window_maxima - {:.3f} s, {} tops'.format(time.time() - start, len(tops)))
+
+def _griddata_sample(dem, x, y):
+    """Samples a DEM with a one-shot griddata call, which triangulates the DEM on every call."""
+    from scipy.interpolate import griddata
+    rows, cols = np.nonzero(~np.isnan(dem.array))
+    centers = np.stack((dem.grid.las.min[0] + (cols + 0.5) * dem.cell_size,
+                        dem.grid.las.min[1] + (rows + 0.5) * dem.cell_size), axis=1)
+    return griddata(centers, dem.array[rows, cols], (x, y), method="linear")
+
+def bench_terrain_model(path=test_las, cell_size=1, repeats=5):
+    """Compares sampling a DEM repeatedly with griddata and with a TerrainModel that is triangulated once."""
+    cloud = pyfor.cloud.Cloud(path)
+    dem = cloud.grid(cell_size).ground_filter(7, 2.5, 1)
+    x, y = cloud.las.points["x"], cloud.las.points["y"]
+
+    start = time.time()
+    for i in range(repeats):
+        _griddata_sample(dem, x, y)
+    print('Terrain model - griddata x {} - {:.3f} s'.format(repeats, time.time() - start))
+
+    start = time.time()
+    model = pyfor.terrain.TerrainModel.from_raster(dem)
+    for i in range(repeats):
+        model.sample(x, y)
+    print('Terrain model - TerrainModel x {} - {:.3f} s'.format(repeats, time.time() - start))
+
+def bench_ground_filters(path=test_las):
+    """Compares the zhang and csf ground filters on the same tile, the first csf call includes its compilation."""
+    for cell_size in [0.5, 1, 2]:
+        for method in ["zhang", "csf"]:
+            grid = pyfor.cloud.Cloud(path).grid(cell_size)
+            start = time.time()
+            dem = grid.ground_filter(7, 2.5, 1, method=method)
+            print('Ground filter - {} - {} - {:.3f} s'.format(cell_size, method, time.time() - start))
+            if dem.array is not None:
+                print('Ground filter - {} - {} - median DEM: {:.2f}'.format(cell_size, method, np.median(dem.array)))
 
 ## Initialize cloud
 #print('Initialize cloud: {}'.format(time_func('pyfor.cloud.Cloud("data/test.las")')))
@@ -28,3 +416,29 @@ def time_func(func_string):
 #print('Normalize grid - 0.5: {}'.format(time_func('test_cloud.normalize(0.5)')))
 #print('Normalize grid - 1: {}'.format(time_func('test_cloud.normalize(1)')))
 
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else test_las
+    bench_load(path)
+    bench_lazy_open(path)
+    bench_dims(path)
+    bench_chunks(path)
+    bench_plot_extraction(path)
+    bench_spatial_sort(path)
+    bench_index(path)
+    bench_cache(path)
+    bench_integer_coords(path)
+    bench_filter_chain(path)
+    bench_grid(path)
+    bench_raster_reducers(path)
+    bench_metrics(path)
+    bench_polygon_metrics(path)
+    bench_repeated_chm(path)
+    bench_interpolate(path)
+    bench_normalize(path)
+    bench_zhang(path)
+    bench_ground_filters(path)
+    bench_terrain_model(path)
+    bench_pit_filter(path)
+    bench_pit_free_chm(path)
+    bench_local_maxima(path)
@@ -20,6 +20,151 @@ test_las = os.path.join(data_dir, 'test.las')
 test_shp = os.path.join(data_dir, 'clip.shp')
 proj4str = "+proj=utm +zone=10 +ellps=GRS80 +datum=NAD83 +units=m +no_defs"
 
+class MetricsTestCase(unittest.TestCase):
+    def test_group_metrics(self):
+        groups, group_metrics = metrics.group_metrics(np.array([3, 3, 3, 3, 1]), np.array([4., 1., 3., 2., 5.]))
+        np.testing.assert_array_equal(groups, [1, 3])
+        self.assertEqual(list(group_metrics.keys()), metrics.metric_names())
+        np.testing.assert_array_equal(group_metrics["count"], [1, 4])
+        np.testing.assert_allclose(group_metrics["p50"], [5, 2.5])
+        np.testing.assert_allclose(group_metrics["cover"], [1, 0.5])
+        self.assertTrue(np.isnan(group_metrics["std"][0]))
+
+class InterpolationTestCase(unittest.TestCase):
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.array = state.rand(40, 50)
+        self.array[state.rand(40, 50) < 0.3] = np.nan
+        self.array[:10, :10] = np.nan
+
+    def test_fill_nan_nearest(self):
+        filled = interpolation.fill_nan(self.array, "nearest")
+        self.assertFalse(np.isnan(filled).any())
+        known = ~np.isnan(self.array)
+        np.testing.assert_array_equal(filled[known], self.array[known])
+
+    def test_fill_nan_linear(self):
+        from scipy.interpolate import griddata
+        known = np.nonzero(~np.isnan(self.array))
+        rows, cols = np.mgrid[0:40, 0:50]
+        expected = griddata(np.stack(known, axis=1), self.array[known], (rows, cols), method="linear")
+        filled = interpolation.fill_nan(self.array, "linear")
+        np.testing.assert_array_equal(np.isnan(filled), np.isnan(expected))
+
+        # Any triangulation reproduces a plane, so this does not depend on how ties between diagonals are broken
+        plane = 2 * rows + 3 * cols + 1.0
+        expected = np.where(np.isnan(expected), np.nan, plane)
+        np.testing.assert_allclose(interpolation.fill_nan(np.where(np.isnan(self.array), np.nan, plane), "linear"),
+                                   expected)
+
+    def test_fill_nan_max_distance(self):
+        filled = interpolation.fill_nan(self.array, "nearest", max_distance=2)
+        self.assertTrue(np.isnan(filled[0, 0]))
+        self.assertFalse(np.isnan(filled[9, 9]))
+
+class TerrainModelTestCase(unittest.TestCase):
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.x, self.y = state.rand(2000) * 100, state.rand(2000) * 100
+        self.z = np.sin(self.x / 10) + self.y / 10
+        self.model = terrain.TerrainModel(self.x, self.y, self.z)
+        self.query = state.rand(5000, 2) * 110 - 5
+
+    def test_sample(self):
+        from scipy.interpolate import LinearNDInterpolator
+        expected = LinearNDInterpolator(np.stack((self.x, self.y), axis=1), self.z)(self.query)
+        sampled = self.model.sample(self.query[:, 0], self.query[:, 1], extrapolate=False, chunk_size=1000, n_jobs=2)
+        np.testing.assert_allclose(sampled, expected)
+        self.assertFalse(np.isnan(self.model.sample(self.query[:, 0], self.query[:, 1])).any())
+
+    def test_save_load(self):
+        path = os.path.join(data_dir, "temp_test_terrain.pkl")
+        self.model.save(path)
+        loaded = terrain.TerrainModel.load(path)
+        os.remove(path)
+        np.testing.assert_array_equal(loaded.sample(self.query[:, 0], self.query[:, 1]),
+                                      self.model.sample(self.query[:, 0], self.query[:, 1]))
+
+    def test_rasterize(self):
+        test_cloud = cloud.Cloud(test_las)
+        model = terrain.TerrainModel.from_raster(test_cloud.grid(1).ground_filter(7, 2.5, 1))
+        grid = test_cloud.grid(0.5)
+        raster = model.rasterize(grid)
+        self.assertEqual(raster.array.shape, (grid.m, grid.n))
+        self.assertFalse(np.isnan(raster.array).any())
+
+class FilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_grid = cloud.Cloud(test_las).grid(1)
+        self.min_z = self.test_grid.interpolate("min", "z").array
+
+    def test_zhang_matches_loop(self):
+        # The original cell by cell implementation, also used by performance.bench_zhang
+        from pyfortest.performance import _zhang_loop
+        expected = _zhang_loop(self.min_z.copy(), 7, 2.5, 1, 1, self.test_grid)
+        dem = filter.zhang(self.min_z.copy(), 7, 2.5, 1, 1, self.test_grid)
+        np.testing.assert_array_equal(dem, expected)
+
+    def test_window_thresholds(self):
+        A = np.array([[0, 1, 2], [0, 0, 0.1]])
+        # The smallest window uses dh_0
+        np.testing.assert_allclose(filter.window_thresholds(A, 3, 0, 1, 2.5, 1), [[1], [1]])
+        # A slope of 1 is not capped, as in filter.dht
+        np.testing.assert_allclose(filter.window_thresholds(A, 9, 5, 1, 2.5, 1), [[5], [5]])
+        np.testing.assert_allclose(filter.window_thresholds(A, 9, 5, 1, 2.5, 1, slope=0.25), [[2], [2]])
+        np.testing.assert_allclose(filter.window_thresholds(A, 9, 5, 1, 2.5, 1, slope=0.5), [[2.5], [2.5]])
+        # Slopes of 1 and 0.05, the first is capped at dh_max
+        np.testing.assert_allclose(filter.window_thresholds(A, 9, 5, 1, 2.5, 1, slope="local"), [[2.5], [1.2]])
+
+    def test_zhang_slope(self):
+        for slope in [0.5, "local"]:
+            dem = filter.zhang(self.min_z.copy(), 7, 2.5, 1, 1, self.test_grid, slope=slope)
+            self.assertEqual(dem.shape, self.min_z.shape)
+
+    def test_csf(self):
+        # A flat surface with a 10 unit high block, a stiffer cloth bridges the block
+        surface = np.zeros((40, 40))
+        surface[15:25, 15:25] = 10
+        surface[0, 0] = np.nan
+        dem = filter.csf(surface, rigidness=2)
+        self.assertEqual(dem.shape, surface.shape)
+        self.assertFalse(np.isnan(dem).any())
+        self.assertLess(np.max(np.abs(dem)), 1)
+
+    def test_csf_slope(self):
+        # A 30 unit high hill with slopes of up to 50 degrees and a 10 x 10 x 10 block on the flat terrain
+        for cell_size in [1, 2]:
+            centers = np.arange(0, 120, cell_size) + cell_size / 2
+            x, y = np.meshgrid(centers, centers)
+            ground = 30 * np.exp(-((x - 60)**2 + (y - 60)**2) / (2 * 15**2))
+            block = (np.abs(x - 25) < 5) & (np.abs(y - 25) < 5)
+            dem = filter.csf(np.where(block, ground + 10, ground), cell_size=cell_size)
+            self.assertLess(np.max(ground) - np.max(dem), 0.1)
+            self.assertLess(np.max(np.abs(dem - ground)[~block]), 1.5)
+            self.assertLess(np.max(dem[block] - ground[block]), 2)
+
+    def test_median_filter(self):
+        from scipy.ndimage import generic_filter
+        state = np.random.RandomState(0)
+        array = state.rand(40, 50)
+        array[state.rand(40, 50) < 0.2] = np.nan
+        array[:6, :6] = np.nan
+        for kernel_size in [3, 5]:
+            expected = generic_filter(array, np.nanmedian, size=kernel_size, mode="constant", cval=np.nan)
+            np.testing.assert_array_equal(filter.median_filter(array, kernel_size, tile_size=16, n_jobs=2), expected)
+        self.assertRaises(ValueError, filter.median_filter, array, 4)
+
+    def test_median_filter_repeated_values(self):
+        from scipy.ndimage import generic_filter
+        state = np.random.RandomState(1)
+        array = np.round(state.rand(40, 50) * 5)
+        array[state.rand(40, 50) < 0.2] = np.nan
+        for kernel_size in [3, 5, 7]:
+            expected = generic_filter(array, np.nanmedian, size=kernel_size, mode="constant", cval=np.nan)
+            for tile_size in [7, 16]:
+                np.testing.assert_array_equal(filter.median_filter(array, kernel_size, tile_size=tile_size, n_jobs=2),
+                                              expected)
+
 class CloudDataTestCase(unittest.TestCase):
     def setUp(self):
         self.test_points = {
@@ -57,8 +202,139 @@ class CloudDataTestCase(unittest.TestCase):
 
         os.remove(os.path.join(data_dir, "temp_test_write.las"))
 
+    def test_points_are_columnar(self):
+        self.assertEqual(type(self.test_cloud_data.points), pointstore.PointStore)
+        self.assertEqual(self.test_cloud_data.count, 2)
+
     # TODO tear down
 
+class PointStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_store = pointstore.PointStore({
+            "x": np.array([0.0, 1.0, 2.0]),
+            "y": np.array([0.0, 1.0, 2.0]),
+            "intensity": np.array([10, 20, 30], dtype=np.uint16)
+        })
+
+    def test_native_dtypes(self):
+        self.assertEqual(self.test_store["intensity"].dtype, np.uint16)
+        self.assertEqual(self.test_store.intensity.dtype, np.uint16)
+
+    def test_take(self):
+        subset = self.test_store[self.test_store["x"] > 0]
+        self.assertEqual(len(subset), 2)
+        self.assertEqual(subset["intensity"].dtype, np.uint16)
+
+    def test_select_shared(self):
+        selected = self.test_store.select(self.test_store["x"] > 0)
+        self.assertTrue(self.test_store.is_shared("x"))
+        self.test_store["x"] = self.test_store["x"] - 10
+        self.assertFalse(self.test_store.is_shared("x"))
+        np.testing.assert_array_equal(selected["x"], [1, 2])
+
+    def test_column_subset_values(self):
+        xy = self.test_store[["x", "y"]].values
+        self.assertEqual(xy.shape, (3, 2))
+
+    def test_set_wrong_length(self):
+        with self.assertRaises(ValueError):
+            self.test_store["z"] = [1, 2]
+
+    def test_scaled(self):
+        self.test_store["X"] = np.array([100, 200, 300], dtype=np.int32)
+        self.test_store.add_scaled("scaled_x", "X", 0.01, 1000)
+        np.testing.assert_allclose(self.test_store["scaled_x"], [1001, 1002, 1003])
+        self.test_store["scaled_x"] = np.array([1001.5, 1002, 1003])
+        np.testing.assert_array_equal(self.test_store["X"], [150, 200, 300])
+        self.assertEqual(self.test_store["X"].dtype, np.int32)
+
+    def test_to_pandas(self):
+        df = self.test_store.to_pandas()
+        self.assertEqual(type(df), pd.DataFrame)
+        self.assertEqual(list(df.columns), ["x", "y", "intensity"])
+
+class LasIOTestCase(unittest.TestCase):
+    def test_read_header(self):
+        header = lasio.read_header(test_las)
+        laspy_header = laspy.file.File(test_las).header
+        self.assertEqual(header.point_records_count, laspy_header.point_records_count)
+        self.assertEqual(header.min, list(laspy_header.min))
+        for name in ["file_signature", "version", "version_major", "version_minor", "data_format_id", "data_offset"]:
+            self.assertEqual(getattr(header, name), getattr(laspy_header, name))
+
+    def test_decode_matches_laspy(self):
+        las = laspy.file.File(test_las)
+        header = lasio.read_header(test_las)
+        records = lasio.memmap_points(test_las, header)
+        for dim in ["x", "intensity", "return_num", "classification"]:
+            np.testing.assert_allclose(lasio.decode(records, dim, header), getattr(las, dim))
+
+class SpatialTestCase(unittest.TestCase):
+    def test_morton_code(self):
+        codes = spatial.morton_code(np.array([0, 1, 0, 1, 2]), np.array([0, 0, 1, 1, 0]))
+        np.testing.assert_array_equal(codes, [0, 1, 2, 3, 4])
+
+    def test_hilbert_adjacent(self):
+        ix, iy = np.meshgrid(np.arange(16), np.arange(16))
+        ix, iy = ix.ravel(), iy.ravel()
+        order = np.argsort(spatial.hilbert_code(ix, iy, 4))
+        steps = np.abs(np.diff(ix[order])) + np.abs(np.diff(iy[order]))
+        self.assertTrue(np.all(steps == 1))
+
+class LasIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = lasindex.build_index(test_las, cell_size=10)
+
+    def test_index_file(self):
+        self.assertTrue(os.path.exists(lasindex.index_path(test_las)))
+        loaded = lasindex.load_index(test_las)
+        np.testing.assert_array_equal(loaded.starts, self.index.starts)
+
+    def test_indexed_read(self):
+        poly = gpd.read_file(test_shp)['geometry'][0]
+        unindexed = cloud.Cloud(test_las).clip(poly)
+        indexed = cloud.Cloud(test_las, polygon=poly)
+        self.assertEqual(indexed.las.count, unindexed.las.count)
+
+    def tearDown(self):
+        os.remove(lasindex.index_path(test_las))
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = os.path.join(data_dir, "temp_cache")
+        self.test_cache = cache.DiskCache(self.cache_dir, max_bytes=1e9)
+
+    def test_cached_load(self):
+        first = cloud.Cloud(test_las, cache=self.test_cache)
+        self.assertEqual(len(self.test_cache.entries), 1)
+        second = cloud.Cloud(test_las, cache=self.test_cache)
+        self.assertEqual(type(second.las.points["z"]), np.memmap)
+        self.assertFalse(second.las.points["z"].flags.owndata)
+        np.testing.assert_array_equal(first.las.points["z"], second.las.points["z"])
+        self.assertEqual(second.las.count, cloud.Cloud(test_las).las.count)
+
+    def test_normalize_cached(self):
+        cloud.Cloud(test_las, cache=self.test_cache)
+        cached = cloud.Cloud(test_las, cache=self.test_cache)
+        expected = cloud.Cloud(test_las)
+        expected.normalize(1)
+        cached.normalize(1)
+        # z is modified in place through the copy on write memory map, the cache is unchanged
+        self.assertEqual(type(cached.las.points["z"]), np.memmap)
+        np.testing.assert_allclose(cached.las.points["z"], expected.las.points["z"])
+        np.testing.assert_array_equal(cloud.Cloud(test_las, cache=self.test_cache).las.points["z"],
+                                      cloud.Cloud(test_las).las.points["z"])
+
+    def test_eviction(self):
+        cloud.Cloud(test_las, cache=self.test_cache)
+        self.test_cache.max_bytes = 0
+        self.test_cache.evict()
+        self.assertEqual(len(self.test_cache.entries), 0)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
 class CloudTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -68,6 +344,52 @@ class CloudTestCase(unittest.TestCase):
         """Tests if a .las file succesfully loads when cloud.Cloud is called"""
         self.assertEqual(type(self.test_cloud), cloud.Cloud)
 
+    def test_native_dtypes(self):
+        self.assertEqual(self.test_cloud.las.points["intensity"].dtype, np.uint16)
+        self.assertEqual(self.test_cloud.las.points["classification"].dtype, np.uint8)
+
+    def test_lazy_load(self):
+        lazy_cloud = cloud.Cloud(test_las, lazy=True)
+        self.assertEqual(lazy_cloud.las.count, self.test_cloud.las.count)
+        self.assertFalse(lazy_cloud.las.points.is_loaded("intensity"))
+        np.testing.assert_array_equal(lazy_cloud.las.points["intensity"], self.test_cloud.las.points["intensity"])
+        np.testing.assert_allclose(lazy_cloud.las.points["z"], self.test_cloud.las.points["z"])
+        self.assertTrue(lazy_cloud.las.points.is_loaded("intensity"))
+
+    def test_load_dims(self):
+        dims_cloud = cloud.Cloud(test_las, dims=["classification"])
+        self.assertEqual(dims_cloud.las.points.columns, ["x", "y", "z", "classification"])
+        self.assertEqual(dims_cloud.las.count, self.test_cloud.las.count)
+
+    def test_load_unknown_dims(self):
+        with self.assertRaises(ValueError):
+            cloud.Cloud(test_las, dims=["not_a_dimension"])
+
+    def test_write_dims(self):
+        out_path = os.path.join(data_dir, "temp_test_write_dims.las")
+        cloud.Cloud(test_las, dims=["classification"]).write(out_path)
+        read = laspy.file.File(out_path)
+        np.testing.assert_array_equal(read.classification, self.test_cloud.las.points["classification"])
+        read.close()
+        os.remove(out_path)
+
+    def test_iter_chunks(self):
+        chunks = list(cloud.Cloud.iter_chunks(test_las, chunk_size=100000))
+        self.assertEqual(sum(chunk.count for chunk in chunks), self.test_cloud.las.count)
+        self.assertEqual(type(chunks[0]), cloud.CloudData)
+        self.assertLessEqual(chunks[0].count, 100000)
+        self.assertEqual(type(chunks[0].header), lasio.LasHeader)
+
+    def test_chunked_write(self):
+        out_path = os.path.join(data_dir, "temp_test_chunked_write.las")
+        with lasio.LasWriter(out_path, test_las) as writer:
+            for chunk in cloud.Cloud.iter_chunks(test_las, chunk_size=100000):
+                writer.write(chunk)
+        written = cloud.Cloud(out_path)
+        self.assertEqual(written.las.count, self.test_cloud.las.count)
+        np.testing.assert_allclose(written.las.points["z"], self.test_cloud.las.points["z"])
+        os.remove(out_path)
+
     def test_grid_creation(self):
         """Tests if the grid is successfully created."""
         # Does the call to grid return the proper type
@@ -80,10 +402,118 @@ class CloudTestCase(unittest.TestCase):
         self.assertLessEqual(self.test_filter.las.max[2], [41])
         self.assertGreaterEqual(self.test_filter.las.min[2], [40])
 
+    def test_filter_chain(self):
+        chained = cloud.Cloud(test_las)
+        chained.filter(40, 45, "z")
+        chained.filter(0, 100, "intensity")
+        z, intensity = self.test_cloud.las.points["z"], self.test_cloud.las.points["intensity"]
+        expected = (z > 40) & (z < 45) & (intensity > 0) & (intensity < 100)
+        self.assertEqual(chained.las.count, np.count_nonzero(expected))
+
+        # Dimensions that were not filtered on are only gathered when they are read
+        self.assertFalse(chained.las.points.is_loaded("classification"))
+        np.testing.assert_array_equal(chained.las.points["classification"],
+                                      self.test_cloud.las.points["classification"][expected])
+        self.assertTrue(chained.las.points.is_loaded("classification"))
+
     def test_clip_polygon(self):
         poly = gpd.read_file(test_shp)['geometry'][0]
         self.test_cloud.clip(poly)
 
+    def test_read_polygon(self):
+        poly = gpd.read_file(test_shp)['geometry'][0]
+        clipped = self.test_cloud.clip(poly)
+        pushed_down = cloud.Cloud(test_las, polygon=poly)
+        self.assertEqual(pushed_down.las.count, clipped.las.count)
+
+    def test_clip_lazy_integer_coords(self):
+        poly = gpd.read_file(test_shp)['geometry'][0]
+        lazy = cloud.Cloud(test_las, lazy=True, integer_coords=True)
+        clipped = lazy.clip(poly)
+        self.assertEqual(clipped.las.count, self.test_cloud.clip(poly).las.count)
+        self.assertIsNotNone(clipped.las.points.raw_coordinate("x"))
+
+    def test_filter_then_clip(self):
+        poly = gpd.read_file(test_shp)['geometry'][0]
+        for test_cloud in [self.test_cloud, cloud.Cloud(test_las, lazy=True)]:
+            test_cloud.filter(5, 20, "z")
+            clipped = test_cloud.clip(poly)
+            # The clip applies to the filtered points, the file is not read again
+            self.assertGreater(clipped.las.count, 0)
+            self.assertGreater(np.min(clipped.las.points["z"]), 5)
+            self.assertLess(np.max(clipped.las.points["z"]), 20)
+
+    def test_clip_then_normalize(self):
+        poly = gpd.read_file(test_shp)['geometry'][0]
+        clipped = self.test_cloud.clip(poly)
+        expected = cloud.Cloud(test_las).clip(poly).las.points["z"]
+        self.test_cloud.normalize(1)
+        np.testing.assert_array_equal(clipped.las.points["z"], expected)
+
+    def test_grid_memoized(self):
+        grid = self.test_cloud.grid(1)
+        self.assertIs(self.test_cloud.grid(1), grid)
+
+        # Memoized rasters are copies, modifying one does not change the next
+        chm = self.test_cloud.chm(1)
+        chm.array[:] = 0
+        np.testing.assert_array_equal(self.test_cloud.chm(1).array, grid.raster(np.max, "z").array)
+
+        # Assigning z invalidates the rasters but not the binning
+        self.test_cloud.las.points["z"] = self.test_cloud.las.points["z"] + 1
+        self.assertIs(self.test_cloud.grid(1), grid)
+        self.assertAlmostEqual(np.nanmax(self.test_cloud.chm(1).array), self.test_cloud.las.max[2] + 1)
+
+        self.test_cloud.filter(40, 45, "z")
+        self.assertIsNot(self.test_cloud.grid(1), grid)
+
+    def test_polygon_metrics(self):
+        polygons = gpd.read_file(test_shp)
+        plot_metrics = self.test_cloud.polygon_metrics(polygons)
+        self.assertEqual(len(plot_metrics), len(polygons))
+        np.testing.assert_array_equal(plot_metrics.index, polygons.index)
+
+        clipped = self.test_cloud.clip(polygons['geometry'][0])
+        self.assertEqual(plot_metrics["count"].iloc[0], clipped.las.count)
+        self.assertAlmostEqual(plot_metrics["p90"].iloc[0], np.percentile(clipped.las.points["z"], 90))
+
+        self.assertEqual(list(self.test_cloud.polygon_metrics(polygons, ["mean", "p75"]).columns), ["mean", "p75"])
+        with self.assertRaises(ValueError):
+            self.test_cloud.polygon_metrics(polygons, ["median"])
+
+    def test_read_bounds(self):
+        bounds = (405010, 3276310, 405030, 3276330)
+        pushed_down = cloud.Cloud(test_las, bounds=bounds)
+        in_clip = clip_funcs.square_clip(self.test_cloud, bounds)
+        self.assertEqual(pushed_down.las.count, np.sum(in_clip))
+
+    def test_sort_spatial(self):
+        sorted_cloud = cloud.Cloud(test_las)
+        sorted_cloud.sort_spatial()
+        self.assertEqual(sorted_cloud.las.count, self.test_cloud.las.count)
+        np.testing.assert_allclose(np.sort(sorted_cloud.las.points["z"]), np.sort(self.test_cloud.las.points["z"]))
+
+        # Consecutive points should be much closer than in acquisition order
+        def mean_step(points):
+            return np.mean(np.hypot(np.diff(points["x"]), np.diff(points["y"])))
+        self.assertLess(mean_step(sorted_cloud.las.points), mean_step(self.test_cloud.las.points))
+
+    def test_integer_coords(self):
+        int_cloud = cloud.Cloud(test_las, integer_coords=True)
+        self.assertEqual(int_cloud.las.points["X"].dtype, np.int32)
+        np.testing.assert_allclose(int_cloud.las.points["x"], self.test_cloud.las.points["x"])
+        self.assertLess(int_cloud.las.points.nbytes, self.test_cloud.las.points.nbytes)
+
+        bounds = (405010, 3276310, 405030, 3276330)
+        np.testing.assert_array_equal(clip_funcs.square_clip(int_cloud, bounds),
+                                      clip_funcs.square_clip(self.test_cloud, bounds))
+
+    def test_integer_coords_write_lossless(self):
+        out_path = os.path.join(data_dir, "temp_test_write_int.las")
+        cloud.Cloud(test_las, integer_coords=True).write(out_path)
+        np.testing.assert_array_equal(laspy.file.File(out_path).X, laspy.file.File(test_las).X)
+        os.remove(out_path)
+
     def test_plot_return(self):
         # FIXME broken on travis-ci
         #plot = self.test_cloud.plot(return_plot=True)
@@ -109,9 +539,85 @@ class CloudTestCase(unittest.TestCase):
         test_cloud.normalize(0.5)
         self.assertLess(test_cloud.las.max[2], 65)
 
+    def test_normalize_in_place(self):
+        test_cloud = cloud.Cloud(test_las)
+        z = test_cloud.las.points["z"]
+        test_cloud.normalize(0.5)
+        self.assertIs(test_cloud.las.points["z"], z)
+        self.assertAlmostEqual(test_cloud.las.max[2], np.max(z))
+
+    def test_normalize_bilinear(self):
+        nearest, bilinear = cloud.Cloud(test_las), cloud.Cloud(test_las)
+        nearest.normalize(1)
+        bilinear.normalize(1, sampling="bilinear")
+        self.assertLess(bilinear.las.max[2], 65)
+        # Both sample the same DEM, the difference is bounded by the relief of neighbouring cells
+        self.assertLess(np.median(np.abs(nearest.las.points["z"] - bilinear.las.points["z"])), 1)
+
+    def test_normalize_with_raster(self):
+        dem = self.test_cloud.grid(1).ground_filter(7, 2.5, 1)
+        expected = cloud.Cloud(test_las)
+        expected.normalize(1)
+        self.test_cloud.normalize_with(dem, sampling="nearest")
+        np.testing.assert_allclose(self.test_cloud.las.points["z"], expected.las.points["z"])
+
+    def test_normalize_with_terrain_model(self):
+        dem = self.test_cloud.grid(1).ground_filter(7, 2.5, 1)
+        model = terrain.TerrainModel.from_raster(dem)
+        expected = model.sample(self.test_cloud.las.points["x"], self.test_cloud.las.points["y"])
+        z = self.test_cloud.las.points["z"].copy()
+        self.test_cloud.normalize_with(model)
+        np.testing.assert_allclose(self.test_cloud.las.points["z"], z - expected)
+
+    def test_normalize_with_geotiff(self):
+        dem = self.test_cloud.grid(1).ground_filter(7, 2.5, 1)
+        dem.grid.cloud.crs = proj4str
+        dem_path = os.path.join(data_dir, "temp_test_dem.tif")
+        dem.write(dem_path)
+        for sampling in ["nearest", "bilinear"]:
+            # Reading the DEM back gives the same heights as the Raster it was written from
+            expected = cloud.Cloud(test_las)
+            expected.normalize_with(dem, sampling=sampling)
+            from_file = cloud.Cloud(test_las)
+            from_file.normalize_with(dem_path, sampling=sampling)
+            np.testing.assert_allclose(from_file.las.points["z"], expected.las.points["z"])
+        os.remove(dem_path)
+
+    def test_classify_ground(self):
+        ground = self.test_cloud.classify_ground(1)
+        self.assertGreater(np.count_nonzero(ground), 0)
+        np.testing.assert_array_equal(self.test_cloud.las.points["classification"] == 2, ground)
+
+        out_path = os.path.join(data_dir, "temp_test_classified.las")
+        self.test_cloud.write(out_path)
+        read = laspy.file.File(out_path)
+        self.assertEqual(np.count_nonzero(read.classification == 2), np.count_nonzero(ground))
+        read.close()
+        os.remove(out_path)
+
+    def test_classify_then_normalize(self):
+        self.test_cloud.classify_ground(1)
+        grid = self.test_cloud.grid(1)
+        key = ("ground_filter", "zhang", 7, 2.5, 1, "nearest", None)
+        dem = grid._products[key][1]
+        self.test_cloud.normalize(1)
+        # The DEM of classify_ground is reused, not recomputed
+        self.assertIs(grid._products[key][1], dem)
+
+    def test_normalize_csf(self):
+        dem = self.test_cloud.grid(1).ground_filter(method="csf")
+        self.assertFalse(np.isnan(dem.array).any())
+        self.test_cloud.normalize(1, method="csf")
+        self.assertTrue(self.test_cloud.normalized)
+        self.assertLess(np.abs(np.median(self.test_cloud.las.points["z"])), 10)
+
     def test_chm(self):
         self.test_cloud.chm(0.5, interp_method="nearest", pit_filter= "median")
 
+    def test_chm_pit_free(self):
+        chm = self.test_cloud.chm(0.5, interp_method="nearest", pit_filter="pit_free")
+        self.assertFalse(np.isnan(chm.array).any())
+
     def test_chm_without_interpolation_method(self):
         self.assertEqual(type(self.test_cloud.chm(0.5, interp_method=None)), rasterizer.Raster)
 
@@ -125,10 +631,15 @@ class GridTestCase(unittest.TestCase):
         self.test_grid = cloud.Cloud(test_las).grid(1)
 
     def test_m(self):
-        self.assertEqual(199, self.test_grid.m)
+        # The rows cover the extent of the cloud, only the last row extends past it
+        extent = self.test_grid.las.max[1] - self.test_grid.las.min[1]
+        self.assertGreaterEqual(self.test_grid.m, extent)
+        self.assertLess(self.test_grid.m - 1, extent)
 
     def test_n(self):
-        self.assertEqual(199, self.test_grid.n)
+        extent = self.test_grid.las.max[0] - self.test_grid.las.min[0]
+        self.assertGreaterEqual(self.test_grid.n, extent)
+        self.assertLess(self.test_grid.n - 1, extent)
 
     def test_cloud(self):
         self.assertEqual(type(self.test_grid.cloud), cloud.Cloud)
@@ -138,13 +649,44 @@ class GridTestCase(unittest.TestCase):
 
     def test_empty_cells(self):
         empty = self.test_grid.empty_cells
+        # The occupied 1 x 1 cells of the grid, binned directly from the laspy coordinates
+        las = laspy.file.File(test_las)
+        m = int(np.ceil(las.header.max[1] - las.header.min[1]))
+        n = int(np.ceil(las.header.max[0] - las.header.min[0]))
+        cols = np.minimum(np.floor(las.x - las.header.min[0]), n - 1).astype(int)
+        rows = np.minimum(np.floor(las.y - las.header.min[1]), m - 1).astype(int)
+        occupied = np.unique(rows * n + cols)
         # Check that there are the correct number
-        self.assertEqual(empty.shape, (693, 2))
-        # TODO Check at least one off-diagonal coordinate is non empty ([0 9] for example)
+        self.assertEqual(empty.shape, (m * n - len(occupied), 2))
+        self.assertEqual(len(np.intersect1d(empty[:, 0] * n + empty[:, 1], occupied)), 0)
+
+    def test_cell_index(self):
+        points = self.test_grid.las.points
+        self.assertNotIn("bins_x", points)
+        bins_x = np.clip(np.floor((points["x"] - self.test_grid.las.min[0])), 0, self.test_grid.n - 1)
+        bins_y = np.clip(np.floor((points["y"] - self.test_grid.las.min[1])), 0, self.test_grid.m - 1)
+        np.testing.assert_array_equal(self.test_grid.cell_id, bins_y * self.test_grid.n + bins_x)
+
+        # The points of each cell are contiguous in the index
+        index = self.test_grid.cell_index
+        self.assertEqual(index.cell_ptr[-1], len(points))
+        self.assertTrue(np.all(np.diff(self.test_grid.cell_id[index.order]) >= 0))
 
     def test_raster(self):
         raster = self.test_grid.raster("max", "z")
         self.assertEqual(type(raster), rasterizer.Raster)
+        self.assertEqual(raster.array.shape, (self.test_grid.m, self.test_grid.n))
+
+    def test_raster_reducers(self):
+        # The fast reducers should match the pandas results
+        for func in ["max", "min", "mean", "sum", "count", "std"]:
+            fast = self.test_grid.raster(func, "z").array
+            pandas = self.test_grid.raster(lambda z: getattr(pd.Series(z), func)(), "z").array
+            np.testing.assert_allclose(fast, pandas)
+
+    def test_raster_returns(self):
+        first = self.test_grid.raster("count", "z", returns="first").array
+        self.assertEqual(np.nansum(first), np.count_nonzero(self.test_grid.las.points["return_num"] == 1))
 
     def test_interpolate(self):
         self.test_grid.interpolate("max", "z")
@@ -161,6 +703,38 @@ class GridTestCase(unittest.TestCase):
         self.test_grid.metrics(test_metrics_dict)
         self.test_grid.metrics(test_metrics_dict, as_raster=True)
 
+    def test_standard_metrics(self):
+        stack = self.test_grid.standard_metrics()
+        self.assertEqual(stack.array.shape, (len(stack), self.test_grid.m, self.test_grid.n))
+
+        z = pd.Series(self.test_grid.las.points["z"])
+        cells = z.groupby(self.test_grid.cell_id)
+        for name, expected in [("mean", cells.mean()), ("std", cells.std()), ("skewness", cells.skew()),
+                               ("p90", cells.quantile(0.9)), ("max", cells.max())]:
+            np.testing.assert_allclose(stack[name].array.ravel()[expected.index], expected.values, atol=1e-8)
+
+    def test_pit_free_chm(self):
+        chm = self.test_grid.pit_free_chm(n_jobs=2)
+        self.assertEqual(chm.array.shape, (self.test_grid.m, self.test_grid.n))
+        self.assertLessEqual(np.nanmax(chm.array), self.test_grid.las.max[2])
+
+    def test_pit_free_chm_fills_pits(self):
+        # A conical crown sampled every 0.25 units, the first returns of a 1 x 1 patch inside it hit the ground
+        state = np.random.RandomState(0)
+        x, y = [values.ravel() + state.uniform(-0.05, 0.05, 6400) for values in np.mgrid[0:20:0.25, 0:20:0.25]]
+        z = np.maximum(20 - np.hypot(x - 10, y - 10), 0)
+        pit = (np.abs(x - 12.5) < 0.5) & (np.abs(y - 12.5) < 0.5)
+        z[pit] = 0.5
+        points = pd.DataFrame({"x": x, "y": y, "z": z, "return_num": np.ones(len(x), dtype=np.uint8)})
+        crown = cloud.Cloud(cloud.CloudData(points, None))
+        crown.normalized = True
+
+        grid = crown.grid(0.5)
+        row, col = [int(np.floor((12.5 - minimum) / 0.5)) for minimum in (grid.las.min[1], grid.las.min[0])]
+        self.assertLess(grid.raster("max", "z").array[row, col], 1)
+        chm = crown.chm(0.5, pit_filter="pit_free")
+        self.assertGreater(chm.array[row, col], 20 - np.hypot(2.5, 2.5) - 1)
+
     def tearDown(self):
         del self.test_grid.las.header
 
@@ -190,6 +764,26 @@ class RasterTestCase(unittest.TestCase):
     def test_watershed_seg_out_oriented_correctly(self):
         pass
 
+    def test_variable_window_maxima(self):
+        grid = self.test_raster.grid
+        rows, cols = np.mgrid[0:grid.m, 0:grid.n]
+        array = np.zeros((grid.m, grid.n))
+        for row, col, height in [(20, 20, 25), (20, 60, 15), (100, 150, 30)]:
+            array = np.maximum(array, height - 0.6 * np.hypot(rows - row, cols - col))
+        array[0, 0] = np.nan
+        tops = rasterizer.Raster(array, grid).variable_window_maxima()
+        self.assertEqual(list(tops.columns), ["x", "y", "height"])
+        self.assertEqual(sorted(tops["height"]), [15, 25, 30])
+        top = tops[tops["height"] == 30].iloc[0]
+        self.assertAlmostEqual(top["x"], grid.las.min[0] + 150.5)
+        self.assertAlmostEqual(top["y"], grid.las.min[1] + 100.5)
+
+        # Every cell is a top, so there is no background label
+        tops = rasterizer.Raster(np.full((grid.m, grid.n), 10.0), grid).variable_window_maxima()
+        self.assertEqual(len(tops), 1)
+        self.assertAlmostEqual(tops["x"].iloc[0], grid.las.min[0] + 0.5)
+        self.assertAlmostEqual(tops["y"].iloc[0], grid.las.min[1] + 0.5)
+
     def test_convex_hull_mask(self):
         self.test_raster._convex_hull_mask
 